@@ -0,0 +1,114 @@
+import re
+from typing import Iterator, Optional
+
+_NONZERO = re.compile(rb"[^\x00]")
+# positions of the set bits in each byte value, high bit first
+_BIT_POSITIONS = [tuple(bit for bit in range(8) if byte & (0x80 >> bit)) for byte in range(256)]
+
+class Bitfield:
+    '''
+    Piece bitset in wire order (piece 0 is the high bit of byte 0) kept in a
+    bytearray, so testing or setting one piece is O(1) and never copies, and
+    a BITFIELD payload is the buffer as is. Whole-set operations go through
+    Python ints, which combine the sets a machine word at a time in C, and
+    iterating skips zero bytes with a regex scan. The int form is cached
+    until the next change, and the number of set bits is tracked so full and
+    empty sets are recognised in O(1).
+    '''
+    __slots__ = ("size", "bits", "count", "value")
+
+    def __init__(self, size: int, data: Optional[bytes] = None):
+        self.size = size
+        self.value: Optional[int] = None
+        nbytes = (size + 7) // 8
+        if data is None:
+            self.bits = bytearray(nbytes)
+            self.count = 0
+            return
+        self.bits = bytearray(data[:nbytes])
+        self.bits.extend(bytes(nbytes - len(self.bits)))
+        spare = nbytes * 8 - size
+        if spare:
+            # spare bits must be zero; a peer that sets them should not skew the counts
+            self.bits[-1] &= (0xFF << spare) & 0xFF
+        self.count = self._int().bit_count()
+
+    @classmethod
+    def _from_int(cls, size: int, value: int) -> "Bitfield":
+        bitfield = cls.__new__(cls)
+        bitfield.size = size
+        bitfield.bits = bytearray(value.to_bytes((size + 7) // 8, "big"))
+        bitfield.count = value.bit_count()
+        bitfield.value = value
+        return bitfield
+
+    def _int(self) -> int:
+        if self.value is None:
+            self.value = int.from_bytes(self.bits, "big")
+        return self.value
+
+    def __contains__(self, piece_idx: int) -> bool:
+        return 0 <= piece_idx < self.size and bool(self.bits[piece_idx >> 3] & (0x80 >> (piece_idx & 7)))
+
+    def set(self, piece_idx: int) -> bool:
+        '''Sets the bit; returns False if it was already set.'''
+        mask = 0x80 >> (piece_idx & 7)
+        if self.bits[piece_idx >> 3] & mask:
+            return False
+        self.bits[piece_idx >> 3] |= mask
+        self.count += 1
+        self.value = None
+        return True
+
+    def clear(self, piece_idx: int) -> bool:
+        mask = 0x80 >> (piece_idx & 7)
+        if not self.bits[piece_idx >> 3] & mask:
+            return False
+        self.bits[piece_idx >> 3] &= ~mask & 0xFF
+        self.count -= 1
+        self.value = None
+        return True
+
+    @property
+    def complete(self) -> bool:
+        return self.count == self.size
+
+    def __and__(self, other: "Bitfield") -> "Bitfield":
+        return Bitfield._from_int(self.size, self._int() & other._int())
+
+    def __or__(self, other: "Bitfield") -> "Bitfield":
+        return Bitfield._from_int(self.size, self._int() | other._int())
+
+    def and_not(self, other: "Bitfield") -> "Bitfield":
+        '''Pieces set here but not in other, e.g. what a peer has that we still need.'''
+        return Bitfield._from_int(self.size, self._int() & ~other._int())
+
+    def any_not_in(self, other: "Bitfield") -> bool:
+        if other.complete or not self.count:
+            return False
+        return bool(self._int() & ~other._int())
+
+    def _iter_bytes(self, first: int, last: int) -> Iterator[int]:
+        bits = self.bits
+        for match in _NONZERO.finditer(bits, first, last):
+            byte_idx = match.start()
+            base = byte_idx * 8
+            for bit in _BIT_POSITIONS[bits[byte_idx]]:
+                yield base + bit
+
+    def __iter__(self) -> Iterator[int]:
+        '''Indices of the set bits in increasing order.'''
+        return self._iter_bytes(0, len(self.bits))
+
+    def iter_from(self, start: int) -> Iterator[int]:
+        '''Indices of the set bits from start upwards, then wrapping around to those below it.'''
+        first = start >> 3
+        for piece_idx in self._iter_bytes(first, len(self.bits)):
+            if piece_idx >= start:
+                yield piece_idx
+        for piece_idx in self._iter_bytes(0, first + 1):
+            if piece_idx < start:
+                yield piece_idx
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.bits)
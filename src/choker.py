@@ -0,0 +1,91 @@
+import math
+import random
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from peer_manager import PeerState
+
+RECHOKE_INTERVAL = 10.0
+OPTIMISTIC_INTERVAL = 30.0
+# peers connected for less than this get a better chance at the optimistic slot
+NEW_PEER_AGE = 60.0
+NEW_PEER_WEIGHT = 3
+MIN_UPLOAD_SLOTS = 4
+MAX_UPLOAD_SLOTS = 16
+# upload rate each unchoked peer should be able to get; capacity / this = slots
+SLOT_RATE = 64 * 1024
+# per-round decay of the peak upload rate used as the capacity estimate
+CAPACITY_DECAY = 0.95
+
+class Choker:
+    '''
+    Tit-for-tat choker. Every RECHOKE_INTERVAL the interested peers are ranked
+    by the rate they give us (or, while seeding, by the rate we reach uploading
+    to them) and the best get the regular slots. One more slot is handed out
+    optimistically and rotated every OPTIMISTIC_INTERVAL, favouring newly
+    connected peers so they can get their first pieces. The number of slots
+    follows the measured upload capacity. Only state changes are returned, so
+    CHOKE and UNCHOKE are sent once per transition.
+    '''
+    def __init__(self, peers: Dict[str, PeerState], max_slots: int = MAX_UPLOAD_SLOTS):
+        self.peers = peers
+        self.max_slots = max_slots
+        self.capacity = 0.0
+        self.optimistic: Optional[str] = None
+        self.optimistic_since = 0.0
+
+    def upload_slots(self, upload_rate: float) -> int:
+        '''Total slots, the optimistic one included, sized from the peak upload rate seen.'''
+        self.capacity = max(upload_rate, self.capacity * CAPACITY_DECAY)
+        return self._slot_count()
+
+    def _slot_count(self) -> int:
+        slots = math.ceil(self.capacity / SLOT_RATE) + 1
+        return max(MIN_UPLOAD_SLOTS, min(self.max_slots, slots))
+
+    def _pick_optimistic(self, candidates: List[PeerState], now: float) -> Optional[str]:
+        if not candidates:
+            return None
+        weights = [NEW_PEER_WEIGHT if now - p.connected_at < NEW_PEER_AGE else 1 for p in candidates]
+        return random.choices(candidates, weights)[0].peer_id
+
+    def _changes(self, unchoke: Set[str]) -> List[Tuple[str, bool]]:
+        '''(peer id, choke) for every peer whose state differs from the wanted one.'''
+        changes = []
+        for peer_id, peer in self.peers.items():
+            choke = peer_id not in unchoke
+            if choke != peer.am_choking:
+                peer.am_choking = choke
+                changes.append((peer_id, choke))
+        return changes
+
+    def rechoke(self, upload_rate: float, seeding: bool, now: Optional[float] = None) -> List[Tuple[str, bool]]:
+        now = time.time() if now is None else now
+        slots = self.upload_slots(upload_rate)
+        interested = [p for p in self.peers.values() if p.peer_interested and p.writer is not None]
+        if seeding:
+            interested.sort(key=lambda p: p.meters.upload.rate(), reverse=True)
+        else:
+            interested.sort(key=lambda p: p.meters.download.rate(), reverse=True)
+
+        unchoke = {p.peer_id for p in interested[:slots - 1]}
+        optimistic = self.peers.get(self.optimistic)
+        if (optimistic is None or not optimistic.peer_interested or self.optimistic in unchoke
+                or now - self.optimistic_since >= OPTIMISTIC_INTERVAL):
+            self.optimistic = self._pick_optimistic(
+                [p for p in interested if p.peer_id not in unchoke], now)
+            self.optimistic_since = now
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+        return self._changes(unchoke)
+
+    def fill_free_slots(self) -> List[Tuple[str, bool]]:
+        '''Unchokes newly interested peers into unused slots without waiting for the next round.'''
+        slots = self._slot_count()
+        unchoke = {peer_id for peer_id, p in self.peers.items() if not p.am_choking}
+        for peer_id, p in self.peers.items():
+            if len(unchoke) >= slots:
+                break
+            if p.peer_interested and p.am_choking and p.writer is not None:
+                unchoke.add(peer_id)
+        return self._changes(unchoke)
@@ -0,0 +1,243 @@
+import asyncio
+import math
+import time
+from dataclasses import dataclass
+import weakref
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set, Tuple
+
+Endpoint = Tuple[str, int]
+
+MAX_CONNECTIONS = 50
+MAX_HALF_OPEN = 8
+BACKOFF_BASE = 15.0
+MAX_BACKOFF = 30 * 60.0
+# wait before redialing a peer that disconnected cleanly
+RECONNECT_DELAY = 60.0
+# hash failures a peer may share with others before it is banned
+HASH_FAIL_STRIKES = 3
+MAX_CANDIDATES = 1000
+# limits shared by every torrent of a session
+SESSION_MAX_CONNECTIONS = 500
+SESSION_MAX_HALF_OPEN = 32
+
+@dataclass
+class Candidate:
+    ip: str
+    port: int
+    peer_id: Optional[str] = None
+    failures: int = 0
+    next_attempt: float = 0.0
+    # bytes the peer delivered over all of its past connections
+    delivered: int = 0
+    connected: bool = False
+
+    @property
+    def endpoint(self) -> Endpoint:
+        return (self.ip, self.port)
+
+    def score(self) -> float:
+        # peers that delivered data come first, repeated failures sink a peer
+        return math.log2(1 + self.delivered) - 4 * self.failures
+
+class ConnectionBudget:
+    '''
+    Connection limits shared by the connection managers of all torrents in a
+    session, on top of each torrent's own limits. When a connection or dial
+    ends, every manager is woken so an idle torrent can use the freed slot.
+    '''
+    def __init__(self, max_connections: int = SESSION_MAX_CONNECTIONS, max_half_open: int = SESSION_MAX_HALF_OPEN):
+        self.max_connections = max_connections
+        self.max_half_open = max_half_open
+        self.connections = 0
+        self.half_open = 0
+        self.managers: "weakref.WeakSet[ConnectionManager]" = weakref.WeakSet()
+
+    def can_dial(self) -> bool:
+        return self.connections + self.half_open < self.max_connections and self.half_open < self.max_half_open
+
+    def can_accept(self) -> bool:
+        return self.connections < self.max_connections
+
+    def freed(self):
+        for manager in list(self.managers):
+            manager.wakeup.set()
+
+# dial(ip, port, on_handshake) runs one outgoing connection until it ends and returns
+# (handshake completed, bytes delivered); on_handshake(peer_id) returns False to refuse it
+Dialer = Callable[[str, int, Callable[[str], bool]], Awaitable[Tuple[bool, int]]]
+
+class ConnectionManager:
+    '''
+    Decides which peers we are connected to. Tracker results go into a pool
+    of candidates; whenever a slot is free the best-scoring candidate that is
+    not backing off is dialed, with at most max_half_open dials in flight and
+    max_connections established or pending connections in total, incoming
+    ones included. Failed dials back off exponentially per endpoint. IPs
+    that sent data for pieces failing the hash check get strikes, and an IP
+    that was the only source of a bad piece, or reaches HASH_FAIL_STRIKES,
+    is banned and its connections dropped, even if it already left. Given a ConnectionBudget, the
+    session-wide limits apply as well.
+    '''
+    def __init__(self, dial: Dialer, disconnect: Callable[[str], Awaitable[None]],
+                 max_connections: int = MAX_CONNECTIONS, max_half_open: int = MAX_HALF_OPEN,
+                 budget: Optional[ConnectionBudget] = None):
+        self.dial = dial
+        self.disconnect = disconnect
+        self.max_connections = max_connections
+        self.max_half_open = max_half_open
+        self.candidates: Dict[Endpoint, Candidate] = {}
+        self.half_open: Set[Endpoint] = set()
+        # peer id -> ip of every established connection, both directions
+        self.connected: Dict[str, str] = {}
+        self.banned: Set[str] = set()
+        # keyed by IP, so a peer cannot shed its strikes by reconnecting with a new peer id
+        self.strikes: Dict[str, int] = {}
+        self.wakeup = asyncio.Event()
+        self.tasks: Set[asyncio.Task] = set()
+        self.budget = budget
+        if budget is not None:
+            budget.managers.add(self)
+
+    def add_candidates(self, peers: Iterable[Tuple]):
+        '''Adds (ip, port, peer_id) tuples from a tracker; known endpoints keep their history.'''
+        for peer in peers:
+            ip, port, peer_id = peer[0], peer[1], peer[2]
+            if ip in self.banned:
+                continue
+            candidate = self.candidates.get((ip, port))
+            if candidate is None:
+                if len(self.candidates) >= MAX_CANDIDATES:
+                    continue
+                self.candidates[(ip, port)] = Candidate(ip, port, peer_id)
+            elif peer_id:
+                candidate.peer_id = peer_id
+        self.wakeup.set()
+
+    @property
+    def connection_count(self) -> int:
+        return len(self.connected) + len(self.half_open)
+
+    def _can_dial(self) -> bool:
+        if self.connection_count >= self.max_connections or len(self.half_open) >= self.max_half_open:
+            return False
+        return self.budget is None or self.budget.can_dial()
+
+    def _dial_started(self, endpoint: Endpoint):
+        self.half_open.add(endpoint)
+        if self.budget is not None:
+            self.budget.half_open += 1
+
+    def _dial_finished(self, endpoint: Endpoint):
+        if endpoint not in self.half_open:
+            return
+        self.half_open.discard(endpoint)
+        if self.budget is not None:
+            self.budget.half_open -= 1
+            self.budget.freed()
+
+    def _next_candidate(self, now: float) -> Optional[Candidate]:
+        best = None
+        for candidate in self.candidates.values():
+            if (candidate.connected or candidate.next_attempt > now or candidate.ip in self.banned
+                    or candidate.peer_id in self.connected):
+                continue
+            if best is None or candidate.score() > best.score():
+                best = candidate
+        return best
+
+    async def run(self):
+        while True:
+            now = time.time()
+            while self._can_dial():
+                candidate = self._next_candidate(now)
+                if candidate is None:
+                    break
+                candidate.connected = True
+                self._dial_started(candidate.endpoint)
+                task = asyncio.create_task(self._connect(candidate))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+            # sleep until a dial finishes, new candidates arrive or a backoff expires
+            waiting = [c.next_attempt for c in self.candidates.values() if not c.connected and c.ip not in self.banned]
+            timeout = max(1.0, min(waiting) - now) if waiting else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _connect(self, candidate: Candidate):
+        peer_id = None
+
+        def on_handshake(handshake_id: str) -> bool:
+            nonlocal peer_id
+            self._dial_finished(candidate.endpoint)
+            if not self.accept(handshake_id, candidate.ip):
+                return False
+            peer_id = candidate.peer_id = handshake_id
+            return True
+
+        handshaked, delivered = False, 0
+        try:
+            handshaked, delivered = await self.dial(candidate.ip, candidate.port, on_handshake)
+        except Exception as e:
+            print(f"Error dialing {candidate.ip}:{candidate.port}: {e}")
+        finally:
+            self._dial_finished(candidate.endpoint)
+            if peer_id is not None:
+                self.release(peer_id)
+            candidate.connected = False
+            candidate.delivered += delivered
+            if handshaked:
+                candidate.failures = 0
+                candidate.next_attempt = time.time() + RECONNECT_DELAY
+            else:
+                candidate.failures += 1
+                candidate.next_attempt = time.time() + min(MAX_BACKOFF, BACKOFF_BASE * 2 ** (candidate.failures - 1))
+            self.wakeup.set()
+
+    def accept(self, peer_id: str, ip: str) -> bool:
+        '''Registers an established connection; False if it is banned, a duplicate or over the limit.'''
+        if ip in self.banned or peer_id in self.connected:
+            return False
+        if len(self.connected) >= self.max_connections:
+            return False
+        if self.budget is not None:
+            if not self.budget.can_accept():
+                return False
+            self.budget.connections += 1
+        self.connected[peer_id] = ip
+        return True
+
+    def release(self, peer_id: str):
+        if self.connected.pop(peer_id, None) is None:
+            return
+        if self.budget is not None:
+            self.budget.connections -= 1
+            self.budget.freed()
+        self.wakeup.set()
+
+    def hash_failed(self, piece_idx: int, sources: Set[str]):
+        '''Called with the IPs that sent blocks of a piece that failed verification.'''
+        for ip in sources:
+            self.strikes[ip] = self.strikes.get(ip, 0) + 1
+            if len(sources) == 1 or self.strikes[ip] >= HASH_FAIL_STRIKES:
+                self.ban(ip)
+
+    def ban(self, ip: str):
+        '''Bans the IP whether or not it is still connected, and drops its connections.'''
+        if ip in self.banned:
+            return
+        print(f"Banning {ip} after hash failures")
+        self.banned.add(ip)
+        for endpoint in [e for e in self.candidates if e[0] == ip]:
+            del self.candidates[endpoint]
+        for peer_id in [p for p, peer_ip in self.connected.items() if peer_ip == ip]:
+            task = asyncio.create_task(self.disconnect(peer_id))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def close(self):
+        for task in list(self.tasks):
+            task.cancel()
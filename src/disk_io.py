@@ -0,0 +1,226 @@
+import asyncio
+import queue
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List
+
+from storage import Storage
+
+def _resolve(future: asyncio.Future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+class DiskEngine:
+    '''
+    Runs storage reads and writes on a fixed set of worker threads. Jobs are
+    taken from a single FIFO queue in submission order and complete through
+    asyncio futures, so peers never block the event loop on disk. Storage uses
+    pread/pwrite, so concurrent jobs never share a file position.
+    '''
+    def __init__(self, workers: int = 4, max_pending: int = 256):
+        self.jobs: "queue.SimpleQueue" = queue.SimpleQueue()
+        self.max_pending = max_pending
+        self._slots = None
+        self.threads = [
+            threading.Thread(target=self._worker, name=f"disk-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    @property
+    def slots(self) -> asyncio.Semaphore:
+        # created lazily so it binds to the running loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        return self._slots
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            loop, future, fn, args = job
+            try:
+                result, error = fn(*args), None
+            except BaseException as e:
+                result, error = None, e
+            try:
+                loop.call_soon_threadsafe(_resolve, future, result, error)
+            except RuntimeError:
+                # loop already closed during shutdown
+                pass
+
+    async def submit(self, fn: Callable, *args):
+        '''Queues fn(*args) for a worker; waits when max_pending jobs are already queued.'''
+        async with self.slots:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.jobs.put((loop, future, fn, args))
+            return await future
+
+    async def write(self, storage: Storage, offset: int, data) -> None:
+        await self.submit(storage.write, offset, data)
+
+    async def read(self, storage: Storage, offset: int, length: int) -> bytes:
+        return await self.submit(storage.read, offset, length)
+
+    def close(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+
+FSYNC_NEVER = "never"   # leave durability to the OS
+FSYNC_FLUSH = "flush"   # fsync after every cache flush
+FSYNC_CLOSE = "close"   # fsync once on shutdown
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_FLUSH, FSYNC_CLOSE)
+
+class WriteCache:
+    '''
+    Write-back cache for verified pieces. Pieces are held in memory until the
+    budget is exceeded, the flush timer fires or the cache is closed, and are
+    then written as runs of adjacent pieces with one vectored write per run.
+    Runs that fail to write stay cached for the next flush, but a cache that
+    is still over budget refuses new pieces with OSError instead of growing.
+    '''
+    def __init__(self, disk: DiskEngine, storage: Storage, piece_length: int,
+                 budget: int = 64 * 1024 * 1024, flush_interval: float = 5.0,
+                 fsync: str = FSYNC_NEVER):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"unknown fsync policy {fsync!r}")
+        self.disk = disk
+        self.storage = storage
+        self.piece_length = piece_length
+        self.budget = budget
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.pieces: Dict[int, bytearray] = {}
+        self.size = 0
+        self.flushes = 0
+        self.writes = 0
+        self._lock = None
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def get(self, piece_idx: int):
+        return self.pieces.get(piece_idx)
+
+    async def put(self, piece_idx: int, data) -> None:
+        if self.budget <= 0:
+            await self.disk.write(self.storage, piece_idx * self.piece_length, data)
+            self.writes += 1
+            return
+        if self.size >= self.budget:
+            # an earlier flush failed and left the cache full; make room before taking more
+            await self.flush()
+            if self.size >= self.budget:
+                raise OSError(f"write cache full: {self.size} bytes could not be flushed")
+        self.pieces[piece_idx] = data
+        self.size += len(data)
+        if self.size >= self.budget:
+            await self.flush()
+
+    def _runs(self, indices: List[int]) -> List[List[int]]:
+        runs = []
+        for piece_idx in indices:
+            if runs and runs[-1][-1] + 1 == piece_idx:
+                runs[-1].append(piece_idx)
+            else:
+                runs.append([piece_idx])
+        return runs
+
+    async def flush(self) -> None:
+        async with self.lock:
+            if not self.pieces:
+                return
+            runs = self._runs(sorted(self.pieces))
+            for run in runs:
+                buffers = [self.pieces[piece_idx] for piece_idx in run]
+                try:
+                    await self.disk.submit(self.storage.writev, run[0] * self.piece_length, buffers)
+                except OSError as e:
+                    # keep the run cached and retry on the next flush
+                    print(f"Error flushing pieces {run[0]}-{run[-1]}: {e}")
+                    continue
+                self.writes += 1
+                for piece_idx, data in zip(run, buffers):
+                    del self.pieces[piece_idx]
+                    self.size -= len(data)
+            self.flushes += 1
+            if self.fsync == FSYNC_FLUSH:
+                await self.disk.submit(self.storage.sync)
+
+    async def flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error in write cache flush: {e}")
+
+    async def close(self) -> None:
+        await self.flush()
+        if self.fsync != FSYNC_NEVER:
+            await self.disk.submit(self.storage.sync)
+
+class ReadCache:
+    '''
+    Size-bounded LRU of whole pieces for serving uploads. The first request
+    for a block reads the entire piece ahead, so the following requests for
+    the same piece are served from memory. Concurrent misses on one piece
+    share a single read.
+    '''
+    def __init__(self, load_piece: Callable[[int], Awaitable[bytes]], budget: int = 32 * 1024 * 1024):
+        self.load_piece = load_piece
+        self.budget = budget
+        self.pieces: "OrderedDict[int, bytes]" = OrderedDict()
+        self.loading: Dict[int, asyncio.Future] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, piece_idx: int) -> bytes:
+        data = self.pieces.get(piece_idx)
+        if data is not None:
+            self.hits += 1
+            self.pieces.move_to_end(piece_idx)
+            return data
+
+        self.misses += 1
+        pending = self.loading.get(piece_idx)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self.loading[piece_idx] = future
+        try:
+            data = await self.load_piece(piece_idx)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # mark retrieved so an unawaited failure is not logged
+            future.exception()
+            raise
+        finally:
+            del self.loading[piece_idx]
+        future.set_result(data)
+        self._insert(piece_idx, data)
+        return data
+
+    def _insert(self, piece_idx: int, data: bytes):
+        if len(data) > self.budget:
+            return
+        self.pieces[piece_idx] = data
+        self.size += len(data)
+        while self.size > self.budget:
+            _, evicted = self.pieces.popitem(last=False)
+            self.size -= len(evicted)
@@ -0,0 +1,224 @@
+import asyncio
+import gzip
+import socket
+import ssl
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import certifi
+
+DNS_TTL = 300.0
+IDLE_TIMEOUT = 60.0
+MAX_IDLE_PER_HOST = 4
+MAX_HEADER_SIZE = 64 * 1024
+REQUEST_TIMEOUT = 30.0
+USER_AGENT = "PY0001"
+
+# (scheme, host, port)
+PoolKey = Tuple[str, str, int]
+
+class HTTPError(Exception):
+    '''A response we cannot parse, or a connection that broke mid-response.'''
+
+@dataclass
+class HTTPResponse:
+    status: int
+    headers: Dict[str, str]
+    body: bytes
+
+@dataclass
+class _Connection:
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    idle_since: float = 0.0
+
+    def close(self):
+        self.writer.close()
+
+class HTTPClient:
+    '''
+    Minimal HTTP/1.1 client for tracker requests. Connections are kept alive
+    and pooled per (scheme, host, port), DNS answers are cached for DNS_TTL,
+    and responses may be chunked and gzip or deflate encoded. A request that
+    fails on a pooled connection the server already closed is retried once
+    on a fresh one.
+    '''
+    def __init__(self, request_timeout: float = REQUEST_TIMEOUT):
+        self.request_timeout = request_timeout
+        self.idle: Dict[PoolKey, List[_Connection]] = {}
+        self.dns: Dict[Tuple[str, int], Tuple[List[tuple], float]] = {}
+        self._ssl_context: Optional[ssl.SSLContext] = None
+
+    @property
+    def ssl_context(self) -> ssl.SSLContext:
+        if self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context(cafile=certifi.where())
+        return self._ssl_context
+
+    async def _resolve(self, host: str, port: int) -> List[tuple]:
+        cached = self.dns.get((host, port))
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        addresses = [info[4] for info in infos]
+        self.dns[(host, port)] = (addresses, time.monotonic() + DNS_TTL)
+        return addresses
+
+    async def _open(self, key: PoolKey) -> _Connection:
+        scheme, host, port = key
+        error: Exception = HTTPError(f"no addresses for {host}")
+        for address in await self._resolve(host, port):
+            try:
+                if scheme == "https":
+                    reader, writer = await asyncio.open_connection(
+                        address[0], address[1], ssl=self.ssl_context, server_hostname=host)
+                else:
+                    reader, writer = await asyncio.open_connection(address[0], address[1])
+                return _Connection(reader, writer)
+            except OSError as e:
+                error = e
+        # the cached answer may be stale
+        self.dns.pop((host, port), None)
+        raise error
+
+    def _checkout(self, key: PoolKey) -> Optional[_Connection]:
+        pool = self.idle.get(key)
+        now = time.monotonic()
+        while pool:
+            connection = pool.pop()
+            if now - connection.idle_since < IDLE_TIMEOUT and not connection.reader.at_eof():
+                return connection
+            connection.close()
+        return None
+
+    def _checkin(self, key: PoolKey, connection: _Connection):
+        pool = self.idle.setdefault(key, [])
+        if len(pool) >= MAX_IDLE_PER_HOST:
+            connection.close()
+            return
+        connection.idle_since = time.monotonic()
+        pool.append(connection)
+
+    async def get(self, url: str, timeout: Optional[float] = None) -> HTTPResponse:
+        return await asyncio.wait_for(self._get(url), timeout or self.request_timeout)
+
+    async def _get(self, url: str) -> HTTPResponse:
+        parsed = urlparse(url)
+        scheme = parsed.scheme or "http"
+        if scheme not in ("http", "https"):
+            raise HTTPError(f"unsupported scheme {scheme!r}")
+        port = parsed.port or (443 if scheme == "https" else 80)
+        key = (scheme, parsed.hostname, port)
+        target = (parsed.path or "/") + (f"?{parsed.query}" if parsed.query else "")
+        host_header = parsed.hostname if parsed.port is None else f"{parsed.hostname}:{port}"
+        request = (
+            f"GET {target} HTTP/1.1\r\n"
+            f"Host: {host_header}\r\n"
+            f"User-Agent: {USER_AGENT}\r\n"
+            "Accept: */*\r\n"
+            "Accept-Encoding: gzip, deflate\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        ).encode()
+
+        connection = self._checkout(key)
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = await self._open(key)
+            try:
+                connection.writer.write(request)
+                await connection.writer.drain()
+                response, keep_alive = await self._read_response(connection.reader)
+            except (OSError, asyncio.IncompleteReadError, HTTPError) as e:
+                connection.close()
+                if not reused:
+                    if isinstance(e, asyncio.IncompleteReadError):
+                        raise HTTPError("connection closed before the response was complete") from e
+                    raise
+                # the server closed the idle connection; try once more on a new one
+                connection, reused = None, False
+                continue
+            except BaseException:
+                connection.close()
+                raise
+            if keep_alive:
+                self._checkin(key, connection)
+            else:
+                connection.close()
+            return response
+
+    async def _read_response(self, reader: asyncio.StreamReader) -> Tuple[HTTPResponse, bool]:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            raise HTTPError("response headers too large")
+        if len(head) > MAX_HEADER_SIZE:
+            raise HTTPError("response headers too large")
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise HTTPError(f"bad status line {lines[0]!r}")
+        version, status = parts[0], int(parts[1])
+        headers: Dict[str, str] = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        connection_header = headers.get("connection", "").lower()
+        keep_alive = connection_header != "close" and (version != "HTTP/1.0" or connection_header == "keep-alive")
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            body = await self._read_chunked(reader)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        elif status in (204, 304) or 100 <= status < 200:
+            body = b""
+        else:
+            # delimited by the server closing the connection
+            body = await reader.read()
+            keep_alive = False
+        return HTTPResponse(status, headers, self._decode(body, headers.get("content-encoding", ""))), keep_alive
+
+    async def _read_chunked(self, reader: asyncio.StreamReader) -> bytes:
+        chunks = []
+        while True:
+            size_line = await reader.readuntil(b"\r\n")
+            size = int(size_line.split(b";", 1)[0].strip() or b"0", 16)
+            if size == 0:
+                # skip trailers up to the empty line
+                while await reader.readuntil(b"\r\n") != b"\r\n":
+                    pass
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    @staticmethod
+    def _decode(body: bytes, encoding: str) -> bytes:
+        encoding = encoding.lower()
+        if encoding in ("gzip", "x-gzip"):
+            return gzip.decompress(body)
+        if encoding == "deflate":
+            # zlib-wrapped as the RFC says, or raw deflate as some servers send
+            try:
+                return zlib.decompress(body)
+            except zlib.error:
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+        return body
+
+    def close(self):
+        for pool in self.idle.values():
+            for connection in pool:
+                connection.close()
+        self.idle.clear()
+
+_shared_client: Optional[HTTPClient] = None
+
+def shared_client() -> HTTPClient:
+    '''The client every tracker uses, so connections and DNS answers are shared between torrents.'''
+    global _shared_client
+    if _shared_client is None:
+        _shared_client = HTTPClient()
+    return _shared_client
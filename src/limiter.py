@@ -0,0 +1,154 @@
+import asyncio
+import math
+import time
+import weakref
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+# smallest burst, so a bucket slower than one block per second can still pass a block
+MIN_BURST = 16 * 1024
+
+class TokenBucket:
+    '''
+    Token bucket counting bytes. Tokens refill at `rate` per second up to
+    `burst`; a rate of 0 means unlimited and costs one comparison per call.
+    Waiters are served strictly in arrival order, so peers sending large
+    messages cannot starve the others. A request bigger than the burst is
+    granted once the bucket is full and leaves it in debt.
+    '''
+    def __init__(self, rate: float = 0, burst: Optional[float] = None):
+        self.rate = 0.0
+        self.burst = 0.0
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+        self.pump: Optional[asyncio.Task] = None
+        self.set_rate(rate, burst)
+        self.tokens = self.burst
+
+    @property
+    def unlimited(self) -> bool:
+        return self.rate <= 0
+
+    def set_rate(self, rate: float, burst: Optional[float] = None):
+        '''Changes the rate (bytes/s, 0 = unlimited); waiters are re-timed immediately.'''
+        self._refill()
+        self.rate = max(0.0, float(rate))
+        self.burst = float(burst) if burst else max(self.rate, MIN_BURST)
+        self.tokens = min(self.tokens, self.burst)
+        if self.pump is not None:
+            self.pump.cancel()
+            self.pump = None
+        if self.waiters:
+            self.pump = asyncio.get_running_loop().create_task(self._serve())
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def available(self) -> float:
+        if self.rate <= 0:
+            return math.inf
+        self._refill()
+        return self.tokens
+
+    def spend(self, nbytes: int):
+        '''Takes tokens without waiting, for callers that checked available() first.'''
+        if self.rate > 0:
+            self.tokens -= nbytes
+
+    def delay(self, nbytes: int) -> float:
+        '''Seconds until nbytes (capped at the burst) would be available.'''
+        if self.rate <= 0:
+            return 0.0
+        return max(0.0, min(nbytes, self.burst) - self.available()) / self.rate
+
+    async def consume(self, nbytes: int):
+        if self.rate <= 0:
+            return
+        if not self.waiters:
+            self._refill()
+            if self.tokens >= min(nbytes, self.burst):
+                self.tokens -= nbytes
+                return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((nbytes, future))
+        if self.pump is None:
+            self.pump = asyncio.get_running_loop().create_task(self._serve())
+        await future
+
+    async def _serve(self):
+        try:
+            while self.waiters:
+                nbytes, future = self.waiters[0]
+                if future.done():
+                    # the waiter was cancelled
+                    self.waiters.popleft()
+                    continue
+                if self.rate > 0:
+                    self._refill()
+                    need = min(nbytes, self.burst)
+                    if self.tokens < need:
+                        await asyncio.sleep((need - self.tokens) / self.rate)
+                        continue
+                    self.tokens -= nbytes
+                self.waiters.popleft()
+                future.set_result(None)
+        finally:
+            if self.pump is asyncio.current_task():
+                self.pump = None
+
+class BandwidthLimits:
+    '''
+    Global upload and download buckets plus the rates given to each peer's own
+    buckets. All rates are bytes per second, 0 meaning unlimited, and can be
+    changed at runtime with set_limits(); peers already connected follow the
+    change.
+    '''
+    def __init__(self, upload: float = 0, download: float = 0, peer_upload: float = 0, peer_download: float = 0):
+        self.upload = TokenBucket(upload)
+        self.download = TokenBucket(download)
+        self.peer_upload = peer_upload
+        self.peer_download = peer_download
+        self.peer_upload_buckets: "weakref.WeakSet[TokenBucket]" = weakref.WeakSet()
+        self.peer_download_buckets: "weakref.WeakSet[TokenBucket]" = weakref.WeakSet()
+
+    def peer_buckets(self) -> Tuple[TokenBucket, TokenBucket]:
+        '''New (upload, download) buckets for a peer.'''
+        upload, download = TokenBucket(self.peer_upload), TokenBucket(self.peer_download)
+        self.peer_upload_buckets.add(upload)
+        self.peer_download_buckets.add(download)
+        return upload, download
+
+    def set_limits(self, upload: Optional[float] = None, download: Optional[float] = None,
+                   peer_upload: Optional[float] = None, peer_download: Optional[float] = None):
+        if upload is not None:
+            self.upload.set_rate(upload)
+        if download is not None:
+            self.download.set_rate(download)
+        if peer_upload is not None:
+            self.peer_upload = peer_upload
+            for bucket in list(self.peer_upload_buckets):
+                bucket.set_rate(peer_upload)
+        if peer_download is not None:
+            self.peer_download = peer_download
+            for bucket in list(self.peer_download_buckets):
+                bucket.set_rate(peer_download)
+
+    async def throttle_upload(self, peer_bucket: TokenBucket, nbytes: int):
+        # the peer's own limit first, so a throttled peer holds no global tokens while it waits
+        await peer_bucket.consume(nbytes)
+        await self.upload.consume(nbytes)
+
+    def download_allowance(self, peer_bucket: TokenBucket) -> float:
+        '''Bytes that may be requested right now.'''
+        return min(peer_bucket.available(), self.download.available())
+
+    def download_delay(self, peer_bucket: TokenBucket, nbytes: int) -> float:
+        return max(peer_bucket.delay(nbytes), self.download.delay(nbytes))
+
+    def spend_download(self, peer_bucket: TokenBucket, nbytes: int):
+        peer_bucket.spend(nbytes)
+        self.download.spend(nbytes)
@@ -1,27 +1,41 @@
 import random
 import argparse
 import asyncio
+import os
+import signal
 import sys
 import time
 import tqdm
 from torrent import Torrent
-from tracker import Tracker
-from piece_manager import PieceManager
+from tracker_group import TrackerGroup
+from http_client import shared_client
+from piece_manager import PieceManager, UPLOAD_COPY, UPLOAD_MMAP
+from storage import Storage
+from disk_io import DiskEngine, FSYNC_NEVER, FSYNC_POLICIES
+from limiter import BandwidthLimits
+from connection_manager import ConnectionBudget, SESSION_MAX_CONNECTIONS
 from torrent_client import TorrentClient
+from peer_manager import MAX_INFLIGHT_REQUESTS, RequestBudget
+from session import Session
+from shard import ShardWorker, Supervisor
 from message import MessageType
 
 BLOCK_SIZE = 16384
 KEEP_ALIVE_INTERVAL = 120
 PEER_REFRESH_INTERVAL = 300
+RESUME_SAVE_INTERVAL = 30
+SHARD_STATS_LOG_INTERVAL = 30
 
 class DownloadProgressBar:
-    def __init__(self, total_size: int):
+    def __init__(self, total_size: int, initial: int = 0, desc: str = "Downloading", position: int = 0):
         self.progress_bar = tqdm.tqdm(
             total=total_size,
+            initial=initial,
             unit='B',
             unit_scale=True,
             unit_divisor=1024,
-            desc="Downloading",
+            desc=desc,
+            position=position,
             bar_format='{desc}: {percentage:3.1f}%|{bar}| {n_fmt}/{total_fmt} [{rate_fmt}]'
         )
         self.last_downloaded = 0
@@ -49,7 +63,7 @@ async def keep_alive_loop(torrent_client):
             print(f"Error in keep-alive loop: {e}")
         await asyncio.sleep(30)
 
-async def refresh_peers(tracker: Tracker, torrent_client: TorrentClient, piece_manager: PieceManager):
+async def refresh_peers(tracker: TrackerGroup, torrent_client: TorrentClient, piece_manager: PieceManager):
     metrics = piece_manager.get_metrics()
     updated_peers, interval = await tracker.announce(
         uploaded=metrics["uploaded"],
@@ -58,19 +72,12 @@ async def refresh_peers(tracker: Tracker, torrent_client: TorrentClient, piece_m
         compact=True
     )
 
-    current_peers = torrent_client.get_peer_connections()
-    new_peers = []
-    for peer in updated_peers:
-        peer_id = peer[2] if peer[2] else (peer[0], peer[1])
-        if peer_id not in current_peers:
-            new_peers.append(peer)
-
-    if new_peers:
-        await torrent_client.start_downloading(new_peers)
+    # known endpoints keep their backoff and score in the connection manager
+    await torrent_client.start_downloading(updated_peers)
 
     return interval
 
-async def maintain_peer_list(tracker: Tracker, torrent_client: TorrentClient, piece_manager: PieceManager):
+async def maintain_peer_list(tracker: TrackerGroup, torrent_client: TorrentClient, piece_manager: PieceManager):
     if(torrent_client.port != 1234):
         while True:
             try:
@@ -80,120 +87,248 @@ async def maintain_peer_list(tracker: Tracker, torrent_client: TorrentClient, pi
                 print(f"Error refreshing peers: {e}")
                 await asyncio.sleep(60)
 
-async def update_progress(piece_manager, progress_bar):
+async def update_progress(piece_manager, progress_bar, name: str = ""):
     while True:
         metrics = piece_manager.get_metrics()
         progress_bar.update(metrics["downloaded"])
         if metrics["left"] == 0:
             progress_bar.close()
-            print("\nDownload complete!")
+            print(f"\nDownload complete! {name}")
             # sys.exit(0)
             return
         await asyncio.sleep(0.5)
 
-async def main():
-    # parse cli for torrent file path, client port num
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--file_path", type=str, help="folder you want to save downloaded file at, with leading slash", required=True) # Required parameter
-    parser.add_argument("--port_num", type=int, help="port number you want the client to listen on", required=True)
-    parser.add_argument("--torrent_file", type=str, help="path to the torrent file", required=True)
-    parser.add_argument("--peer", type=str, help="peer in ip:port format (for direct testing)", default=None)
-    parser.add_argument("--compact", action="store_true", help="enable compact mode")
-    args = parser.parse_args()
-
-    print("File Path:", args.file_path)
+async def save_resume_loop(piece_manager: PieceManager):
+    while True:
+        await asyncio.sleep(RESUME_SAVE_INTERVAL)
+        try:
+            await piece_manager.save_resume()
+        except Exception as e:
+            print(f"Error saving resume data: {e}")
 
-    test_file = args.torrent_file
+async def scrape_prompt(tracker: TrackerGroup):
+    while True:
+        sendScrape = input("Would you like to scrape the tracker? (y/n): ")
+        if sendScrape == 'y':
+            try:
+                info = await tracker.scrape()
+            except:
+                print("Could not scrape, moving to download...")
+                break
+            for key, val in info.items():
+                data = val
+            print(f'Peers with entire file: {data[b"complete"]}')
+            print(f"Registered completions: {data[b'downloaded']}")
+            print(f"Number of leechers: {data[b'incomplete']}")
+            while True:
+                moveToDownload = input("Would you like to continue to download? (y/n): ")
+                if moveToDownload == 'y':
+                    break
+                elif moveToDownload == 'n':
+                    print("Goodbye...")
+                    sys.exit(0)
+            break
 
-    # parse through torrent file 
-    torrent = Torrent(test_file)
-    print("Torrent Tracker URL:", torrent.getTrackerURL())
-    print("Torrent File Size:", torrent.getFileSize())
-    print("Torrent Piece Length:", torrent.getPieceLen())
-
-    if(not args.peer):
-        client_id = '-PY0001-' + ''.join([str(random.randint(0, 9)) for _ in range(12)])
-    else:
-        client_id = '-PY0001-' + ''.join([str(0) for _ in range(12)])
+        elif sendScrape == 'n':
+            print("Moving to downloading...")
+            break
 
+async def run_torrent(session: Session, torrent: Torrent, args, client_id: str, position: int, interactive: bool):
+    storage = Storage(args.file_path, torrent.getFiles())
+    # the cache budgets are for the whole session, split evenly between its torrents
+    torrent_count = len(args.torrent_file)
     piece_manager = PieceManager(
         block_size=BLOCK_SIZE,
         hashes=torrent.getPieces(),
-        filepath=f"{args.file_path}{torrent.getFileName()}",
-        total_length=torrent.getFileSize(),
-        piece_length=torrent.getPieceLen()
+        storage=storage,
+        piece_length=torrent.getPieceLen(),
+        resume_path=os.path.join(args.file_path, torrent.getFileName() + ".resume"),
+        disk=session.disk,
+        hash_executor=session.hash_executor,
+        hash_workers=0,
+        write_cache_size=args.write_cache_mb * 1024 * 1024 // torrent_count,
+        fsync=args.fsync,
+        read_cache_size=args.read_cache_mb * 1024 * 1024 // torrent_count,
+        upload_mode=args.upload_mode
     )
 
-    progress_bar = DownloadProgressBar(torrent.getFileSize())
+    if args.recheck or (not piece_manager.load_resume() and piece_manager.had_existing_data):
+        print(f"Checking existing data of {torrent.getFileName()}...")
+        valid = await piece_manager.recheck()
+        print(f"Found {valid}/{piece_manager.num_pieces} valid pieces")
 
-    tracker = Tracker(
-        peer_id=client_id,
+    progress_bar = DownloadProgressBar(torrent.getFileSize(), torrent.getFileSize() - piece_manager.get_metrics()["left"],
+                                       desc=torrent.getFileName() if torrent_count > 1 else "Downloading",
+                                       position=position)
+
+    tracker = TrackerGroup(
+        tiers=torrent.getTrackerTiers(),
         client_port=args.port_num,
-        info_hash=torrent.getInfoHash(),
-        tracker_url=torrent.getTrackerURL(),
-        tracker_port=torrent.getTrackerPort()
+        peer_id=client_id,
+        info_hash=torrent.getInfoHash()
     )
 
-    if torrent.canScrape():
-        while True:
-            sendScrape = input("Would you like to scrape the tracker? (y/n): ")
-            if sendScrape == 'y':
-                try:
-                    info = await tracker.scrape()
-                except:
-                    print("Could not scrape, moving to download...")
-                    break
-                for key, val in info.items():
-                    data = val
-                print(f'Peers with entire file: {data[b"complete"]}')
-                print(f"Registered completions: {data[b'downloaded']}")
-                print(f"Number of leechers: {data[b'incomplete']}")
-                while True:
-                    moveToDownload = input("Would you like to continue to download? (y/n): ")
-                    if moveToDownload == 'y':
-                        break
-                    elif moveToDownload == 'n':
-                        print("Goodbye...")
-                        sys.exit(0)
-                break
-                
-            elif sendScrape == 'n':
-                print("Moving to downloading...")
-                break
-    
-    if args.peer:
-        ip, port = args.peer.split(":")
-        peers = [(ip, int(port), "manual-peer")]
-        interval = 9999
-    else:
-        peers, interval = await tracker.announce(
-            uploaded=0,
-            downloaded=0,
-            left=torrent.getFileSize(),
-            compact=args.compact
+    try:
+        if interactive and torrent.canScrape():
+            await scrape_prompt(tracker)
+
+        if args.peer:
+            ip, port = args.peer.split(":")
+            peers = [(ip, int(port), "manual-peer")]
+        else:
+            try:
+                peers, interval = await tracker.announce(
+                    uploaded=0,
+                    downloaded=0,
+                    left=piece_manager.get_metrics()["left"],
+                    compact=args.compact
+                )
+            except Exception as e:
+                # maintain_peer_list keeps retrying; other torrents in the session carry on
+                print(f"Announce for {torrent.getFileName()} failed: {e}")
+                peers = []
+
+        for peer in peers:
+            print(f"{peer[0], peer[1], peer[2]}")
+
+        torrent_client = session.add_torrent(torrent.getInfoHash(), piece_manager, peers)
+        await asyncio.gather(
+            update_progress(piece_manager, progress_bar, torrent.getFileName()),
+            maintain_peer_list(tracker, torrent_client, piece_manager),
+            keep_alive_loop(torrent_client),
+            save_resume_loop(piece_manager),
+            piece_manager.write_cache.flush_loop()
         )
+    finally:
+        await session.remove_torrent(torrent.getInfoHash())
+        progress_bar.close()
+        await piece_manager.close()
+        storage.close()
+        tracker.close()
 
-    torrent_client = TorrentClient(
-        info_hash=torrent.getInfoHash(),
+def build_session(args, client_id: str, shares: int = 1) -> Session:
+    '''A session with the limits from args, divided evenly when several processes share them.'''
+    return Session(
         my_id=client_id,
-        pieceManager = piece_manager,
-        listen_port=args.port_num
+        listen_port=args.port_num,
+        disk=DiskEngine(workers=args.disk_workers),
+        limits=BandwidthLimits(
+            upload=args.upload_limit_kb * 1024 / shares,
+            download=args.download_limit_kb * 1024 / shares,
+            peer_upload=args.peer_upload_limit_kb * 1024,
+            peer_download=args.peer_download_limit_kb * 1024
+        ),
+        budget=ConnectionBudget(max_connections=max(1, args.max_connections // shares)),
+        hash_workers=args.hash_workers,
+        requests=RequestBudget(max(1, MAX_INFLIGHT_REQUESTS // shares))
     )
 
-    for peer in peers:
-        print(f"{peer[0], peer[1], peer[2]}")
-
+async def run_shard_worker(args, torrent_paths: list, positions: list, client_id: str, shares: int, control):
+    session = build_session(args, client_id, shares)
+    worker = ShardWorker(session, control)
+    # the supervisor stops workers with terminate(); they close their torrents and save resume data
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, worker.stop)
+    downloads = [
+        asyncio.create_task(run_torrent(session, Torrent(path), args, client_id, position, False))
+        for path, position in zip(torrent_paths, positions)
+    ]
     try:
-        await asyncio.gather(
-            torrent_client.run(peers),
-            update_progress(piece_manager, progress_bar),
-            maintain_peer_list(tracker, torrent_client, piece_manager),
-            keep_alive_loop(torrent_client)
+        await worker.run()
+    finally:
+        # every torrent has to finish flushing and saving resume data before the disk engine goes away
+        for task in downloads:
+            task.cancel()
+        await asyncio.gather(*downloads, return_exceptions=True)
+        await session.close()
+        shared_client().close()
+
+def shard_worker_main(*args):
+    # Ctrl-C reaches the whole process group; shutdown is left to the supervisor
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_shard_worker(*args))
+
+async def log_shard_stats(supervisor: Supervisor):
+    while True:
+        await asyncio.sleep(SHARD_STATS_LOG_INTERVAL)
+        stats = supervisor.get_stats()
+        print(f"{stats['workers']} workers, {stats['connections']} peers, "
+              f"down {stats['download_rate'] / 1024:.0f} KiB/s, up {stats['upload_rate'] / 1024:.0f} KiB/s")
+
+async def run_sharded(args, torrents: list, client_id: str):
+    '''Spreads the torrents round-robin over worker processes behind one supervisor-owned port.'''
+    shards = min(args.shards, len(torrents))
+    supervisor = Supervisor(args.port_num)
+    for shard in range(shards):
+        indices = list(range(shard, len(torrents), shards))
+        supervisor.add_worker(
+            [torrents[i].getInfoHash() for i in indices],
+            shard_worker_main,
+            args, [args.torrent_file[i] for i in indices], indices, client_id, shards
         )
+    try:
+        await asyncio.gather(supervisor.run(), log_shard_stats(supervisor))
+    finally:
+        await supervisor.close()
+
+async def main():
+    # parse cli for torrent file paths, client port num
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file_path", type=str, help="folder you want to save downloaded file at, with leading slash", required=True) # Required parameter
+    parser.add_argument("--port_num", type=int, help="port number you want the client to listen on", required=True)
+    parser.add_argument("--torrent_file", type=str, nargs="+", help="path to one or more torrent files, all served on port_num", required=True)
+    parser.add_argument("--peer", type=str, help="peer in ip:port format (for direct testing)", default=None)
+    parser.add_argument("--compact", action="store_true", help="enable compact mode")
+    parser.add_argument("--recheck", action="store_true", help="verify existing data on disk instead of trusting the resume file")
+    parser.add_argument("--disk_workers", type=int, help="threads used for disk reads and writes", default=4)
+    parser.add_argument("--write_cache_mb", type=int, help="memory for verified pieces waiting to be written (0 writes through)", default=64)
+    parser.add_argument("--read_cache_mb", type=int, help="memory for pieces cached to serve uploads (0 disables)", default=32)
+    parser.add_argument("--upload_mode", choices=(UPLOAD_COPY, UPLOAD_MMAP), help="serve uploads from the caches (copy) or straight from an mmap of the file", default=UPLOAD_COPY)
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, help="when to fsync downloaded data", default=FSYNC_NEVER)
+    parser.add_argument("--hash_workers", type=int, help="threads used for SHA-1 piece verification (0 hashes on the event loop)", default=2)
+    parser.add_argument("--upload_limit_kb", type=int, help="total upload limit in KiB/s (0 is unlimited)", default=0)
+    parser.add_argument("--download_limit_kb", type=int, help="total download limit in KiB/s (0 is unlimited)", default=0)
+    parser.add_argument("--peer_upload_limit_kb", type=int, help="upload limit to each peer in KiB/s (0 is unlimited)", default=0)
+    parser.add_argument("--peer_download_limit_kb", type=int, help="download limit from each peer in KiB/s (0 is unlimited)", default=0)
+    parser.add_argument("--max_connections", type=int, help="peer connections across all torrents", default=SESSION_MAX_CONNECTIONS)
+    parser.add_argument("--shards", type=int, help="worker processes the torrents are spread over (1 runs everything in this process)", default=1)
+    args = parser.parse_args()
+
+    print("File Path:", args.file_path)
+
+    # parse through torrent files
+    torrents = [Torrent(path) for path in args.torrent_file]
+    for torrent in torrents:
+        print("Torrent Tracker URL:", torrent.getTrackerURL())
+        print("Torrent File Size:", torrent.getFileSize())
+        print("Torrent Piece Length:", torrent.getPieceLen())
+
+    if(not args.peer):
+        client_id = '-PY0001-' + ''.join([str(random.randint(0, 9)) for _ in range(12)])
+    else:
+        client_id = '-PY0001-' + ''.join([str(0) for _ in range(12)])
+
+    if args.shards > 1:
+        await run_sharded(args, torrents, client_id)
+        return
+
+    session = build_session(args, client_id)
+    tasks = [asyncio.create_task(session.run())] + [
+        # the scrape prompt only makes sense with a single torrent
+        asyncio.create_task(run_torrent(session, torrent, args, client_id, i, len(torrents) == 1))
+        for i, torrent in enumerate(torrents)
+    ]
+    try:
+        await asyncio.gather(*tasks)
     except KeyboardInterrupt:
         print("\nShutting down...")
     finally:
-        progress_bar.close()
+        # a plain gather returns as soon as one child is cancelled; wait for every torrent
+        # to flush its write cache and save resume data before closing the shared disk engine
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await session.close()
+        shared_client().close()
 
 if __name__ == "__main__":
     try:
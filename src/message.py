@@ -224,9 +224,12 @@ class PieceMessage(Message):
         self.block = block
 
     def encode(self) -> bytes:
-        header = struct.pack(">II", self.index, self.begin) # 8 bytes = two 4 byte integer
-        encoding_len = 1 + len(header) + len(self.block)
-        return struct.pack(">IB", encoding_len, MessageType.PIECE) + header + self.block
+        return PieceMessage.header(self.index, self.begin, len(self.block)) + self.block
+
+    @staticmethod
+    def header(index : int, begin : int, block_length : int) -> bytes:
+        # the 13 bytes in front of the block, so a block can be sent without copying it into the message
+        return struct.pack(">IBII", 9 + block_length, MessageType.PIECE, index, begin)
     
     @staticmethod
     def decode(encoded_bytes : bytes):
@@ -2,8 +2,14 @@ import asyncio
 import socket
 import struct
 import time
+from collections import deque
+from typing import Callable, Optional
+from rate import TransferMeters
+from wire import KEEP_ALIVE, WireProtocol, WireWriter
 from message import BitField, Choke, Handshake, Have, Interested, KeepAlive, MessageType, NotInterested, PieceMessage, Request, Unchoke
 
+MAX_UPLOAD_QUEUE = 512
+
 class Peer:
     def __init__(self, info_hash: bytes, my_id: str, coordinator):
         self.info_hash = info_hash
@@ -16,30 +22,15 @@ class Peer:
         self.has_handshaked = False
         self.writer = None
         
-        self.bytes_uploaded_interval = 0
-        self.bytes_downloaded_interval = 0
-        self.upload_rate = 0.0
-        self.download_rate = 0.0
-        self.last_rate_calc_time = time.time()
+        # shared with the coordinator's PeerState, which records downloaded blocks
+        self.meters = TransferMeters(coordinator.meters)
         self.last_sent = time.time()
         self.last_received = time.time()
-
-    def updateRates(self): 
-        '''Calculates the upload + download rates'''
-        now = time.time()
-        timeDelta = now - self.lastRateCalcTime
-
-        if timeDelta > 0:
-            self.uploadRate = self.bytesUploadedInterval / timeDelta
-            self.downloadRate = self.bytesDownloadedInterval / timeDelta
-        else:
-            # Might happen if we call too rapidly
-            self.uploadRate = 0.0
-            self.downloadRate = 0.0
-
-        self.bytesUploadedInterval = 0
-        self.bytesDownloadedInterval = 0
-        self.lastRateCalcTime = time.time()
+        # REQUESTs from the peer waiting to be served; CANCEL removes entries
+        self.upload_queue: deque = deque()
+        self.upload_ready = asyncio.Event()
+        # called with the remote peer id once its handshake is read; returning False drops the connection
+        self.on_handshake: Optional[Callable[[str], bool]] = None
 
     async def connect_to_peer(self, peer_ip, peer_port): 
         try:
@@ -47,10 +38,11 @@ class Peer:
             self.peer_ip = peer_ip
             self.peer_port = peer_port
             
-            reader, writer = await asyncio.wait_for(
-                asyncio.open_connection(peer_ip, peer_port),
+            _, reader = await asyncio.wait_for(
+                asyncio.get_running_loop().create_connection(WireProtocol, peer_ip, peer_port),
                 timeout=5
             )
+            writer = reader.writer
             #print(f"Connection established to {peer_ip}:{peer_port}")
             self.writer = writer
 
@@ -77,21 +69,23 @@ class Peer:
                 self.writer = None
                 
 
-    async def initiate_handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    async def initiate_handshake(self, reader: WireProtocol, writer: WireWriter):
         try:
             handshake = Handshake(self.info_hash, self.my_id)
             writer.write(handshake.encode())
             self.last_sent = time.time()
             await writer.drain()
 
-            data = await reader.readexactly(68)
+            data = await reader.read_handshake()
             recv_handshake = Handshake.decode(data)
-            self.peer_id = recv_handshake.peer_id
 
             if self.info_hash != recv_handshake.info_hash:
                 return False
+            if self.on_handshake is not None and not self.on_handshake(recv_handshake.peer_id):
+                return False
 
-            self.coordinator.add_peer(self.peer_id, writer)
+            self.peer_id = recv_handshake.peer_id
+            self.coordinator.add_peer(self.peer_id, writer, self.meters)
             self.has_handshaked = True
 
             bitfield = self.coordinator.piece_manager.get_bitfield()
@@ -103,68 +97,81 @@ class Peer:
             print(f"{self.peer_ip}:{self.peer_port}:{self.peer_id} Handshake failed: {e}")
             return False
 
-    async def handle_peer_messages(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    async def handle_peer_messages(self, reader: WireProtocol, writer: WireWriter):
+        # blocks we asked for are received straight into their piece buffers
+        reader.block_sink = self.coordinator.piece_manager.block_buffer
+        uploader = asyncio.create_task(self.upload_loop(writer))
         try:
             await self.send_message(writer, MessageType.INTERESTED)
             
             while True:
                 await self.read_message(reader, writer)
         finally:
+            uploader.cancel()
+            # blocks this connection was receiving into piece buffers can now be taken by others
+            self.coordinator.piece_manager.release_blocks(reader)
             self.coordinator.remove_peer(self.peer_id)
 
-    async def read_message(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    async def upload_loop(self, writer: WireWriter):
+        while True:
+            while not self.upload_queue:
+                self.upload_ready.clear()
+                await self.upload_ready.wait()
+            index, begin, length = self.upload_queue.popleft()
+            if self.coordinator.is_peer_choked(self.peer_id):
+                continue
+            block = await self.coordinator.piece_manager.get_block(index, begin, length)
+            if block:
+                await self.send_piece(writer, index, begin, block)
+
+    async def read_message(self, reader: WireProtocol, writer: WireWriter):
         try:
-            len_data = await reader.readexactly(4)
-            total_len = struct.unpack(">I", len_data)[0]
-
-            if total_len == 0:
-                self.last_received = time.time()
-                return
-
-            message_data = await reader.readexactly(total_len)
-            message_id = message_data[0]
+            message_id, payload = await reader.read_frame()
             self.last_received = time.time()
-            payload = message_data[1:] if total_len > 1 else None
+            if message_id == KEEP_ALIVE:
+                return
 
             match message_id:
                 case MessageType.CHOKE:
-                    self.coordinator.set_peer_unchoked(self.peer_id, False)
+                    self.coordinator.set_peer_choking(self.peer_id, True)
                 case MessageType.UNCHOKE:
-                    self.coordinator.set_peer_unchoked(self.peer_id, True)
+                    self.coordinator.set_peer_choking(self.peer_id, False)
+                    self.coordinator.fill_requests(self.peer_id, min_batch=1)
                 case MessageType.INTERESTED:
                     self.coordinator.set_peer_interested(self.peer_id, True)
                 case MessageType.NOT_INTERESTED:
                     self.coordinator.set_peer_interested(self.peer_id, False)
                 case MessageType.BITFIELD:
                     self.coordinator.update_peer_bitfield(self.peer_id, payload)
+                    self.coordinator.fill_requests(self.peer_id, min_batch=1)
                 case MessageType.HAVE:
                     piece_index = struct.unpack(">I", payload)[0]
                     self.coordinator.update_peer_have(self.peer_id, piece_index)
                 case MessageType.PIECE:
-                    piece_msg = PieceMessage.decode(len_data + message_data)
-                    await self.coordinator.piece_manager.recv_block(
-                        piece_msg.index,
-                        piece_msg.begin,
-                        piece_msg.block
-                    )
-                    await self.coordinator.handle_block_received(self.peer_id, piece_msg.index, piece_msg.begin)
-                    self.bytes_downloaded_interval += len(piece_msg.block)
+                    if isinstance(payload, tuple):
+                        # already received into the piece buffer through the block sink
+                        index, begin, length = payload
+                        accepted = await self.coordinator.piece_manager.block_written(index, begin, length, self.peer_ip, reader)
+                    else:
+                        index, begin = struct.unpack_from(">II", payload)
+                        length = len(payload) - 8
+                        accepted = await self.coordinator.piece_manager.recv_block(index, begin, memoryview(payload)[8:], self.peer_ip)
+                    await self.coordinator.handle_block_received(self.peer_id, index, begin, length, accepted)
                 case MessageType.REQUEST:
-                    if not self.coordinator.is_peer_choked(self.peer_id):
-                        request = Request.decode(len_data + message_data)
-                        block = self.coordinator.piece_manager.get_block(
-                            request.index, request.begin, request.length
-                        )
-                        if block:
-                            block_piece = PieceMessage(request.index, request.begin, block)
-                            await self.send_message(writer, MessageType.PIECE, block_piece)
-                            self.bytes_uploaded_interval += len(block)
+                    if not self.coordinator.is_peer_choked(self.peer_id) and len(self.upload_queue) < MAX_UPLOAD_QUEUE:
+                        self.upload_queue.append(struct.unpack(">III", payload))
+                        self.upload_ready.set()
+                case MessageType.CANCEL:
+                    try:
+                        self.upload_queue.remove(struct.unpack(">III", payload))
+                    except ValueError:
+                        pass
 
         except Exception as e:
             print(f"{self.peer_ip}:{self.peer_port}:{self.peer_id} Error reading message: {e}")
             raise
 
-    async def send_message(self, writer: asyncio.StreamWriter, message_id, payload=None):
+    async def send_message(self, writer: WireWriter, message_id, payload=None):
         try:
             
             message = None
@@ -190,22 +197,37 @@ class Peer:
                     message = payload
 
             if message:
-                writer.write(message.encode())
+                data = message.encode()
+                await self.coordinator.throttle_upload(self.peer_id, len(data))
+                writer.write(data)
                 self.last_sent = time.time()
                 await writer.drain()
 
                 if message_id == MessageType.PIECE and payload:
-                    self.bytes_uploaded_interval += len(payload.block)
+                    self.meters.upload.add(len(payload.block))
         
         except Exception as e:
             print(f"{self.peer_ip}:{self.peer_port}:{self.peer_id} Error sending message with id: {message_id} -- {e}")
 
 
+    async def send_piece(self, writer: WireWriter, index: int, begin: int, block: memoryview):
+        '''Sends a PIECE without building the message, so the block view is never copied on our side.'''
+        try:
+            header = PieceMessage.header(index, begin, len(block))
+            await self.coordinator.throttle_upload(self.peer_id, len(header) + len(block))
+            writer.write(header)
+            writer.write(block)
+            self.last_sent = time.time()
+            await writer.drain()
+            self.meters.upload.add(len(block))
+        except Exception as e:
+            print(f"{self.peer_ip}:{self.peer_port}:{self.peer_id} Error sending piece {index}:{begin} -- {e}")
+
     def get_upload_rate(self) -> float:
-        return self.upload_rate
+        return self.meters.upload.rate()
     
     def get_download_rate(self) -> float:
-        return self.download_rate
+        return self.meters.download.rate()
     
     def get_last_sent_time(self) -> float:
         return self.last_sent
\ No newline at end of file
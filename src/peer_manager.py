@@ -1,113 +1,327 @@
 from dataclasses import dataclass
 import asyncio
-from typing import Dict, Set
+import heapq
+import math
+from typing import Callable, Dict, List, Optional, Set, Tuple
 import time
-from message import Request
+from limiter import BandwidthLimits, TokenBucket
+from message import Cancel, Request
+from bitfield import Bitfield
 from piece_manager import Block, PieceManager
+from rate import GLOBAL_METERS, TransferMeters
+from wire import WireWriter
+
+# refill a peer's queue once this many request slots are free
+REQUEST_BATCH = 8
+# outstanding block requests across every torrent sharing a RequestBudget
+MAX_INFLIGHT_REQUESTS = 4000
+
+# request timeouts follow each peer's block round-trip time (RFC 6298 style)
+DEFAULT_REQUEST_TIMEOUT = 10.0
+MIN_REQUEST_TIMEOUT = 2.0
+MAX_REQUEST_TIMEOUT = 30.0
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+
+# per-peer pipeline depth: enough requests to cover the bandwidth-delay product
+# (measured rate x lowest block round trip) plus REQUEST_QUEUE_TIME of extra data
+INITIAL_PEER_REQUESTS = 16
+MIN_PEER_REQUESTS = 4
+REQUEST_QUEUE_TIME = 1.0
 
 @dataclass
 class PeerState:
     peer_id: str
-    bitfield: bytes
-    writer: asyncio.StreamWriter
-    unchoked: bool = False
-    interested: bool = False
+    bitfield: Optional[Bitfield]
+    writer: WireWriter
+    # the peer is choking us: no requests may be sent
+    peer_choking: bool = True
+    # we are choking the peer: its requests are not served
+    am_choking: bool = True
+    peer_interested: bool = False
+    connected_at: float = 0.0
     pending_requests: Set[tuple] = None
     request_timestamps: Dict[tuple, float] = None
+    srtt: Optional[float] = None
+    rttvar: float = 0.0
+    min_rtt: Optional[float] = None
+    meters: TransferMeters = None
+    upload_bucket: TokenBucket = None
+    download_bucket: TokenBucket = None
+    # pending fill_requests retry while the download limit is exhausted
+    throttle_timer: Optional[asyncio.TimerHandle] = None
     
     def __post_init__(self):
         self.pending_requests = set()
         self.request_timestamps = {}
+        self.connected_at = self.connected_at or time.time()
+        if self.meters is None:
+            self.meters = TransferMeters()
+
+    def request_depth(self, block_size: int, max_requests: int) -> int:
+        download_rate = self.meters.download.average()
+        if self.min_rtt is None or not download_rate:
+            return min(INITIAL_PEER_REQUESTS, max_requests)
+        depth = math.ceil(download_rate * (self.min_rtt + REQUEST_QUEUE_TIME) / block_size)
+        return max(MIN_PEER_REQUESTS, min(max_requests, depth))
+
+    def add_rtt_sample(self, rtt: float):
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar += RTT_BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += RTT_ALPHA * (rtt - self.srtt)
+
+    def request_timeout(self) -> float:
+        if self.srtt is None:
+            return DEFAULT_REQUEST_TIMEOUT
+        return min(MAX_REQUEST_TIMEOUT, max(MIN_REQUEST_TIMEOUT, self.srtt + 4 * self.rttvar))
+
+class RequestBudget:
+    '''Cap on outstanding block requests, shared by the peer managers of all torrents in a session.'''
+    def __init__(self, max_requests: int = MAX_INFLIGHT_REQUESTS):
+        self.max_requests = max_requests
+        self.inflight = 0
+
+    def available(self) -> int:
+        return self.max_requests - self.inflight
 
 class PeerManager:
-    def __init__(self, piece_manager: PieceManager, max_peer_requests: int = 300):
+    def __init__(self, piece_manager: PieceManager, max_peer_requests: int = 300,
+                 max_inflight_requests: int = MAX_INFLIGHT_REQUESTS, limits: Optional[BandwidthLimits] = None,
+                 requests: Optional[RequestBudget] = None):
         self.piece_manager = piece_manager
+        self.limits = limits or BandwidthLimits()
+        # upper bound for a single peer's adaptive depth
         self.max_peer_requests = max_peer_requests
+        self.requests = requests or RequestBudget(max_inflight_requests)
         self.peers: Dict[str, PeerState] = {}
-        self.lock = asyncio.Lock()
+        # (deadline, peer_id, request_key, sent_time); entries for answered requests are dropped lazily
+        self.deadlines: List[Tuple[float, str, tuple, float]] = []
+        # peers each outstanding block is requested from; more than one only in endgame
+        self.block_requesters: Dict[tuple, Set[str]] = {}
+        # per-torrent totals; every peer's meters feed these
+        self.meters = TransferMeters(GLOBAL_METERS)
+        # called with the peer id whenever a peer becomes interested
+        self.on_peer_interested: Optional[Callable[[str], None]] = None
         
-    def add_peer(self, peer_id: str, writer: asyncio.StreamWriter):
-        self.peers[peer_id] = PeerState(peer_id=peer_id, bitfield=None, writer=writer)
+    def add_peer(self, peer_id: str, writer: WireWriter, meters: Optional[TransferMeters] = None):
+        upload_bucket, download_bucket = self.limits.peer_buckets()
+        self.peers[peer_id] = PeerState(peer_id=peer_id, bitfield=None, writer=writer,
+                                        meters=meters or TransferMeters(self.meters),
+                                        upload_bucket=upload_bucket, download_bucket=download_bucket)
         
     def remove_peer(self, peer_id: str):
         if peer_id in self.peers:
             peer = self.peers[peer_id]
-            for request in peer.pending_requests:
-                piece_idx, offset = request
-                self.piece_manager.pending_blocks[piece_idx].discard(offset)
+            if peer.bitfield is not None:
+                self.piece_manager.picker.remove_bitfield(peer.bitfield)
+            for request in list(peer.pending_requests):
+                self._drop_request(peer, request)
+            if peer.throttle_timer is not None:
+                peer.throttle_timer.cancel()
             del self.peers[peer_id]
+
+    def _forget(self, peer: PeerState, request_key: tuple) -> Optional[float]:
+        '''Removes a request from the peer's queue; returns when it was sent.'''
+        if request_key in peer.pending_requests:
+            peer.pending_requests.discard(request_key)
+            self.requests.inflight -= 1
+        return peer.request_timestamps.pop(request_key, None)
+
+    def _drop_request(self, peer: PeerState, request_key: tuple):
+        '''Forgets a request; the block goes back to the picker once nobody else has it requested.'''
+        self._forget(peer, request_key)
+        requesters = self.block_requesters.get(request_key)
+        if requesters is not None:
+            requesters.discard(peer.peer_id)
+            if requesters:
+                return
+            del self.block_requesters[request_key]
+        self.piece_manager.cancel_block(*request_key)
             
     def update_peer_bitfield(self, peer_id: str, bitfield: bytes):
         if peer_id in self.peers:
-            self.peers[peer_id].bitfield = bitfield
+            peer = self.peers[peer_id]
+            if peer.bitfield is not None:
+                self.piece_manager.picker.remove_bitfield(peer.bitfield)
+            peer.bitfield = Bitfield(self.piece_manager.num_pieces, bitfield)
+            self.piece_manager.picker.add_bitfield(peer.bitfield)
             
     def update_peer_have(self, peer_id: str, piece_idx: int):
-        if peer_id in self.peers and self.peers[peer_id].bitfield:
-            byte_idx = piece_idx // 8
-            if byte_idx < len(self.peers[peer_id].bitfield):
-                self.peers[peer_id].bitfield = bytearray(self.peers[peer_id].bitfield)
-                self.peers[peer_id].bitfield[byte_idx] |= (1 << (7 - (piece_idx % 8)))
-                self.peers[peer_id].bitfield = bytes(self.peers[peer_id].bitfield)
+        if peer_id not in self.peers or not 0 <= piece_idx < self.piece_manager.num_pieces:
+            return
+        peer = self.peers[peer_id]
+        if peer.bitfield is None:
+            peer.bitfield = Bitfield(self.piece_manager.num_pieces)
+        if peer.bitfield.set(piece_idx):
+            self.piece_manager.picker.add_have(piece_idx)
     
-    def set_peer_unchoked(self, peer_id: str, unchoked: bool):
+    def set_peer_choking(self, peer_id: str, choking: bool):
+        '''Records a CHOKE or UNCHOKE from the peer. A choking peer discards our requests.'''
+        peer = self.peers.get(peer_id)
+        if peer is None:
+            return
+        peer.peer_choking = choking
+        if choking:
+            for request in list(peer.pending_requests):
+                self._drop_request(peer, request)
+
+    def set_am_choking(self, peer_id: str, choking: bool):
         if peer_id in self.peers:
-            self.peers[peer_id].unchoked = unchoked
+            self.peers[peer_id].am_choking = choking
             
     def set_peer_interested(self, peer_id: str, interested: bool):
-        if peer_id in self.peers:
-            self.peers[peer_id].interested = interested
+        peer = self.peers.get(peer_id)
+        if peer is None:
+            return
+        was_interested, peer.peer_interested = peer.peer_interested, interested
+        if interested and not was_interested and self.on_peer_interested:
+            self.on_peer_interested(peer_id)
 
     def is_peer_choked(self, peer_id: str) -> bool:
-        return not (peer_id in self.peers and self.peers[peer_id].unchoked)
+        '''True while we are choking the peer.'''
+        return peer_id not in self.peers or self.peers[peer_id].am_choking
+
+    def fill_requests(self, peer_id: str, min_batch: int = REQUEST_BATCH) -> int:
+        '''
+        Tops up a peer's request queue. All new REQUESTs are encoded into one
+        buffer and written with a single write. Nothing is sent unless at
+        least min_batch slots are free, so refills stay batched. Returns the
+        number of requests sent.
+        '''
+        peer = self.peers.get(peer_id)
+        if peer is None or peer.peer_choking or peer.bitfield is None or peer.writer is None:
+            return 0
+        if not self.piece_manager.is_interesting(peer.bitfield):
+            return 0
+
+        depth = peer.request_depth(self.piece_manager.block_size, self.max_peer_requests)
+        available_slots = min(depth - len(peer.pending_requests), self.requests.available())
+        if available_slots < max(1, min(min_batch, depth // 2)):
+            return 0
+
+        block_size = self.piece_manager.block_size
+        allowance = self.limits.download_allowance(peer.download_bucket)
+        if allowance < available_slots * block_size:
+            available_slots = int(allowance // block_size)
+            if available_slots <= 0:
+                self._retry_when_allowed(peer)
+                return 0
+
+        blocks = self.piece_manager.select_blocks(peer.bitfield, available_slots)
+        if len(blocks) < available_slots and self.piece_manager.in_endgame:
+            # everything left is already requested: ask this peer too and cancel the losers later
+            exclude = peer.pending_requests | {(b.piece_idx, b.offset) for b in blocks}
+            blocks += self.piece_manager.select_endgame_blocks(
+                peer.bitfield, exclude, available_slots - len(blocks))
+        if not blocks:
+            return 0
+
+        try:
+            peer.writer.write(b"".join(Request(b.piece_idx, b.offset, b.length).encode() for b in blocks))
+        except Exception:
+            for block in blocks:
+                if (block.piece_idx, block.offset) not in self.block_requesters:
+                    self.piece_manager.cancel_block(block.piece_idx, block.offset)
+            return 0
+
+        self.limits.spend_download(peer.download_bucket, sum(b.length for b in blocks))
+        now = time.time()
+        deadline = now + peer.request_timeout()
+        for block in blocks:
+            request_key = (block.piece_idx, block.offset)
+            peer.pending_requests.add(request_key)
+            peer.request_timestamps[request_key] = now
+            self.requests.inflight += 1
+            self.block_requesters.setdefault(request_key, set()).add(peer_id)
+            heapq.heappush(self.deadlines, (deadline, peer_id, request_key, now))
+        return len(blocks)
+
+    def _retry_when_allowed(self, peer: PeerState):
+        if peer.throttle_timer is not None:
+            return
+        delay = self.limits.download_delay(peer.download_bucket, self.piece_manager.block_size)
+
+        def retry():
+            peer.throttle_timer = None
+            self.fill_requests(peer.peer_id, min_batch=1)
+        peer.throttle_timer = asyncio.get_running_loop().call_later(delay, retry)
+
+    async def throttle_upload(self, peer_id: str, nbytes: int):
+        '''Waits until nbytes may be sent to the peer under its own and the global upload limit.'''
+        peer = self.peers.get(peer_id)
+        if peer is not None:
+            await self.limits.throttle_upload(peer.upload_bucket, nbytes)
+
+    def expire_requests(self, now: float) -> int:
+        '''Releases requests past their deadline. Only touches expired heap entries.'''
+        expired = 0
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, peer_id, request_key, sent = heapq.heappop(self.deadlines)
+            peer = self.peers.get(peer_id)
+            # skip entries whose request was answered, dropped or re-sent since
+            if peer is None or peer.request_timestamps.get(request_key) != sent:
+                continue
+            self._drop_request(peer, request_key)
+            expired += 1
+        return expired
 
     async def request_blocks(self):
-        async with self.lock:
-            current_time = time.time()
-            
-            peer_list = list(self.peers.items())
-            
-            for peer_id, peer in peer_list:
-                if peer_id not in self.peers:
-                    continue
-                    
-                timed_out = [request for request in peer.pending_requests 
-                            if current_time - peer.request_timestamps.get(request, current_time) > 10]
-                    
-                for request in timed_out:
-                    piece_idx, offset = request
-                    peer.pending_requests.discard(request)
-                    self.piece_manager.pending_blocks[piece_idx].discard(offset)
-                    del peer.request_timestamps[request]
-
-            for peer_id, peer in peer_list:
-                if peer_id not in self.peers:
-                    continue
-                    
-                if not peer.unchoked or not peer.bitfield:
-                    continue
-                    
-                available_slots = self.max_peer_requests - len(peer.pending_requests)
-                if available_slots <= 0:
-                    continue
-                    
-                blocks = self.piece_manager.select_blocks(peer.bitfield, available_slots)
-                if not blocks:
-                    continue
-                    
-                for block in blocks:
-                    request_key = (block.piece_idx, block.offset)
-                    try:
-                        message = Request(block.piece_idx, block.offset, block.length)
-                        peer.writer.write(message.encode())
-                        await peer.writer.drain()
-                        peer.pending_requests.add(request_key)
-                        peer.request_timestamps[request_key] = time.time()
-                    except:
-                        self.piece_manager.pending_blocks[block.piece_idx].discard(block.offset)
+        '''Periodic sweep: expires stale requests and refills every peer.'''
+        self.expire_requests(time.time())
+
+        for peer_id in list(self.peers):
+            self.fill_requests(peer_id, min_batch=1)
                         
-    async def handle_block_received(self, peer_id: str, piece_idx: int, offset: int):
+    async def handle_block_received(self, peer_id: str, piece_idx: int, offset: int, length: int,
+                                    accepted: bool = True):
+        '''
+        length is what arrived on the wire, which unrequested or duplicate blocks
+        count towards too. Only an accepted block answers requests: a rejected
+        one must not cancel the block at the peers that really have it requested.
+        '''
         if peer_id in self.peers:
+            peer = self.peers[peer_id]
+            peer.meters.download.add(length)
+            if not accepted or not 0 <= piece_idx < self.piece_manager.num_pieces:
+                return
             request_key = (piece_idx, offset)
-            self.peers[peer_id].pending_requests.discard(request_key)
-            if request_key in self.peers[peer_id].request_timestamps:
-                del self.peers[peer_id].request_timestamps[request_key]
\ No newline at end of file
+            sent = self._forget(peer, request_key)
+            if sent is not None:
+                peer.add_rtt_sample(time.time() - sent)
+            self.cancel_duplicates(peer_id, request_key)
+            self.fill_requests(peer_id)
+
+    def get_stats(self) -> dict:
+        '''Transfer totals and rates for the torrent and each connected peer.'''
+        stats = self.meters.snapshot()
+        stats["peers"] = {
+            peer_id: dict(
+                peer.meters.snapshot(),
+                pending_requests=len(peer.pending_requests),
+                request_depth=peer.request_depth(self.piece_manager.block_size, self.max_peer_requests),
+                srtt=peer.srtt,
+            )
+            for peer_id, peer in self.peers.items()
+        }
+        return stats
+
+    def cancel_duplicates(self, winner_id: str, request_key: tuple):
+        '''Sends CANCEL to every other peer the block was requested from (endgame).'''
+        requesters = self.block_requesters.pop(request_key, None)
+        if not requesters:
+            return
+        piece_idx, offset = request_key
+        piece = self.piece_manager.pieces[piece_idx]
+        length = piece.block_length(offset // self.piece_manager.block_size)
+        for peer_id in requesters:
+            peer = self.peers.get(peer_id)
+            if peer_id == winner_id or peer is None:
+                continue
+            self._forget(peer, request_key)
+            try:
+                peer.writer.write(Cancel(piece_idx, offset, length).encode())
+            except Exception:
+                pass
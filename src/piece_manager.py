@@ -1,7 +1,30 @@
 from dataclasses import dataclass
-from typing import Dict, List, Set, Optional, Callable
+from bisect import insort
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set, Optional, Callable, Iterator
 import hashlib
 import asyncio
+import json
+import os
+import random
+import time
+from bitfield import Bitfield
+from storage import Storage
+from disk_io import DiskEngine, ReadCache, WriteCache, FSYNC_NEVER
+
+RANDOM_FIRST_PIECES = 4
+
+# per-block states kept in Piece.block_states
+BLOCK_MISSING = 0
+BLOCK_REQUESTED = 1
+BLOCK_RECEIVED = 2
+
+# how blocks are served to peers: copied out of the caches/disk, or sliced from an mmap of the file
+UPLOAD_COPY = "copy"
+UPLOAD_MMAP = "mmap"
+
+RESUME_VERSION = 1
+RECHECK_READ_SIZE = 8 * 1024 * 1024
 
 @dataclass(frozen=True)
 class Block:
@@ -15,139 +38,605 @@ class Piece:
     idx: int
     hash: bytes
     length: int
-    blocks: Dict[int, bytes] = None
+    block_size: int
+    block_states: bytearray = None
+    buffer: Optional[bytearray] = None
     received_blocks: int = 0
     is_complete: bool = False
+    # running SHA-1 over the contiguous prefix of received blocks
+    hasher: object = None
+    hashed_blocks: int = 0
+    # block index -> the connection receiving that block straight into the buffer;
+    # only the owner may write a block's slot, so a slower duplicate cannot overwrite it
+    receivers: Dict[int, object] = None
+    # IPs that sent blocks of the current attempt, blamed if the hash check fails
+    sources: Set[str] = None
+    # received blocks of the current attempt that save_resume already wrote to storage
+    saved: Set[int] = None
     
     def __post_init__(self):
-        if self.blocks is None:
-            self.blocks = {}
+        if self.block_states is None:
+            self.block_states = bytearray(self.num_blocks)
+        if self.sources is None:
+            self.sources = set()
+        if self.saved is None:
+            self.saved = set()
+        if self.receivers is None:
+            self.receivers = {}
+        if self.hasher is None:
+            self.hasher = hashlib.sha1()
+
+    @property
+    def num_blocks(self) -> int:
+        return (self.length + self.block_size - 1) // self.block_size
+
+    def block_length(self, block_idx: int) -> int:
+        return min(self.block_size, self.length - block_idx * self.block_size)
+
+    def reset(self):
+        self.block_states[:] = bytes(len(self.block_states))
+        self.received_blocks = 0
+        self.hasher = hashlib.sha1()
+        self.hashed_blocks = 0
+        self.sources = set()
+        self.saved = set()
+
+class PiecePicker:
+    '''
+    Keeps a swarm availability count per piece and buckets the pieces we still
+    need by that count, one Bitfield per count, so the rarest pieces a peer
+    has are found by intersecting its bitfield with each bucket in turn (int
+    operations over the whole set) instead of testing pieces one at a time.
+    '''
+    def __init__(self, num_pieces: int):
+        self.num_pieces = num_pieces
+        self.availability: List[int] = [0] * num_pieces
+        self.buckets: Dict[int, Bitfield] = {0: Bitfield(num_pieces, b"\xff" * ((num_pieces + 7) // 8))}
+        self.counts: List[int] = [0] if num_pieces else []
+        self.wanted: List[bool] = [True] * num_pieces
+
+    def _bucket_remove(self, piece_idx: int, count: int):
+        bucket = self.buckets[count]
+        bucket.clear(piece_idx)
+        if not bucket.count:
+            del self.buckets[count]
+            self.counts.remove(count)
+
+    def _bucket_add(self, piece_idx: int, count: int):
+        bucket = self.buckets.get(count)
+        if bucket is None:
+            bucket = self.buckets[count] = Bitfield(self.num_pieces)
+            insort(self.counts, count)
+        bucket.set(piece_idx)
+
+    def _adjust(self, piece_idx: int, delta: int):
+        old = self.availability[piece_idx]
+        new = max(0, old + delta)
+        self.availability[piece_idx] = new
+        if self.wanted[piece_idx] and new != old:
+            self._bucket_remove(piece_idx, old)
+            self._bucket_add(piece_idx, new)
+
+    def add_have(self, piece_idx: int):
+        if 0 <= piece_idx < self.num_pieces:
+            self._adjust(piece_idx, 1)
+
+    def add_bitfield(self, bitfield: Bitfield):
+        for piece_idx in bitfield:
+            self._adjust(piece_idx, 1)
+
+    def remove_bitfield(self, bitfield: Bitfield):
+        for piece_idx in bitfield:
+            self._adjust(piece_idx, -1)
+
+    def mark_complete(self, piece_idx: int):
+        if self.wanted[piece_idx]:
+            self.wanted[piece_idx] = False
+            self._bucket_remove(piece_idx, self.availability[piece_idx])
+
+    def pieces(self, peer_bitfield: Bitfield, random_order: bool = False) -> Iterator[int]:
+        '''
+        Yields the wanted pieces the peer has, rarest first. Ties are broken by
+        starting each bucket at a random piece. With random_order the rarity
+        ordering is ignored (used for the first few pieces).
+        '''
+        if not self.num_pieces or not peer_bitfield.count:
+            return
+        if random_order:
+            wanted = Bitfield(self.num_pieces)
+            for count in self.counts:
+                wanted = wanted | self.buckets[count]
+            yield from (wanted & peer_bitfield).iter_from(random.randrange(self.num_pieces))
+            return
+        for count in list(self.counts):
+            bucket = self.buckets.get(count)
+            if count == 0 or bucket is None:
+                continue
+            matched = bucket & peer_bitfield
+            if matched.count:
+                yield from matched.iter_from(random.randrange(self.num_pieces))
 
 class PieceManager:
-    def __init__(self, block_size: int, hashes: List[bytes], filepath: str, 
-                 total_length: int, piece_length: int):
+    def __init__(self, block_size: int, hashes: List[bytes], storage: Storage,
+                 piece_length: int, resume_path: Optional[str] = None, hash_workers: int = 2,
+                 disk: Optional[DiskEngine] = None, write_cache_size: int = 64 * 1024 * 1024,
+                 fsync: str = FSYNC_NEVER, read_cache_size: int = 32 * 1024 * 1024,
+                 upload_mode: str = UPLOAD_COPY, hash_executor: Optional[ThreadPoolExecutor] = None):
         self.block_size = block_size
         self.piece_length = piece_length
-        self.total_length = total_length
+        self.storage = storage
+        self.disk = disk or DiskEngine()
+        self.write_cache = WriteCache(self.disk, storage, piece_length, budget=write_cache_size, fsync=fsync)
+        self.upload_mode = upload_mode
+        self.read_cache = ReadCache(self.read_piece, budget=read_cache_size) if read_cache_size > 0 else None
+        self.total_length = storage.total_length
         self.num_pieces = len(hashes)
         self.total_downloaded = 0
         self.total_uploaded = 0
         self.pieces: Dict[int, Piece] = {}
-        self.completed_pieces: Set[int] = set()
-        self.pending_blocks: Dict[int, Set[int]] = {}
+        # verified pieces; the BITFIELD payload is cached until the next piece completes
+        self.have = Bitfield(self.num_pieces)
+        self._bitfield_bytes: Optional[bytes] = None
+        # running totals so get_metrics never walks the pieces
+        self.bytes_verified = 0
+        self.bytes_wasted = 0
+        self.hash_failures = 0
+        # pieces with at least one block requested or received, finished first
+        self.active_pieces: Dict[int, None] = {}
         self.on_piece_complete: Optional[Callable[[int], None]] = None
+        # called with (piece index, IPs that sent its blocks) when a piece fails verification
+        self.on_hash_failure: Optional[Callable[[int, Set[str]], None]] = None
+        self.picker = PiecePicker(self.num_pieces)
+        # the unhashed tail of a piece is hashed off the event loop; hashlib releases the GIL
+        # a session passes one executor shared by all of its torrents
+        if hash_executor is None and hash_workers > 0:
+            hash_executor = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix="hash")
+        self.hash_executor = hash_executor
+        self.hash_time_offloaded = 0.0
+        self.resume_path = resume_path
         
         for idx, piece_hash in enumerate(hashes):
             piece_length = self.piece_length
             if idx == self.num_pieces - 1:
                 piece_length = self.total_length - (self.piece_length * idx)
             
-            self.pieces[idx] = Piece(idx, piece_hash, piece_length)
-            self.pending_blocks[idx] = set()
+            self.pieces[idx] = Piece(idx, piece_hash, piece_length, self.block_size)
+        # blocks of incomplete pieces that nobody has been asked for; endgame starts at zero
+        self.unrequested_blocks = sum(piece.num_blocks for piece in self.pieces.values())
+
+        # storage keeps whatever is already on disk so it can be resumed or rechecked
+        self.had_existing_data = storage.had_existing_data
 
-        self.file_handle = open(filepath, "wb+")
-        self.file_handle.truncate(total_length)
+    def _reset_piece(self, piece: Piece) -> None:
+        self.unrequested_blocks += piece.num_blocks - piece.block_states.count(BLOCK_MISSING)
+        piece.reset()
+
+    def _mark_complete(self, piece_idx: int) -> None:
+        piece = self.pieces[piece_idx]
+        if not piece.is_complete:
+            self.unrequested_blocks -= piece.block_states.count(BLOCK_MISSING)
+            self.bytes_verified += piece.length
+        piece.is_complete = True
+        piece.buffer = None
+        piece.sources = set()
+        piece.block_states[:] = bytes([BLOCK_RECEIVED]) * piece.num_blocks
+        if self.have.set(piece_idx):
+            self._bitfield_bytes = None
+        self.picker.mark_complete(piece_idx)
+        self.active_pieces.pop(piece_idx, None)
+
+    async def save_resume(self) -> None:
+        '''
+        Persists completed pieces plus the received blocks of partial pieces.
+        Partial block data is written to its final position in storage so it
+        can be read back on load, once per block; file sizes and mtimes are
+        recorded afterwards and checked before the resume data is trusted.
+        '''
+        if not self.resume_path:
+            return
+        # completed pieces must be on disk before the resume file claims them
+        await self.write_cache.flush()
+        # snapshot the new partial blocks first; the buffers keep changing while the writes are queued
+        partial = {}
+        writes = []
+        for piece_idx in list(self.active_pieces):
+            piece = self.pieces[piece_idx]
+            if piece.is_complete or not piece.received_blocks:
+                continue
+            buffer = memoryview(piece.buffer)
+            base = piece_idx * self.piece_length
+            for block_idx, state in enumerate(piece.block_states):
+                if state == BLOCK_RECEIVED and block_idx not in piece.saved:
+                    start = block_idx * self.block_size
+                    # a reset replaces piece.saved, so a block of an abandoned attempt is never marked
+                    writes.append((piece.saved, block_idx, base + start,
+                                   bytes(buffer[start:start + piece.block_length(block_idx)])))
+            partial[str(piece_idx)] = bytes(state == BLOCK_RECEIVED for state in piece.block_states).hex()
+        # a piece a failed flush left in the cache is not on disk, so it is not recorded as completed
+        completed = Bitfield(self.num_pieces, self.get_bitfield())
+        for piece_idx in self.write_cache.pieces:
+            completed.clear(piece_idx)
+
+        for saved, block_idx, offset, data in writes:
+            await self.disk.write(self.storage, offset, data)
+            saved.add(block_idx)
+        if writes:
+            await self.disk.submit(self.storage.sync)
+        resume = {
+            "version": RESUME_VERSION,
+            "piece_length": self.piece_length,
+            "total_length": self.total_length,
+            "completed": completed.to_bytes().hex(),
+            "partial": partial,
+        }
+
+        def write_resume():
+            resume["files"] = self.storage.stat()
+            tmp_path = self.resume_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(resume, f)
+            os.replace(tmp_path, self.resume_path)
+
+        await self.disk.submit(write_resume)
+
+    def load_resume(self) -> bool:
+        '''Restores progress from the resume file. Returns False if it is missing or stale.'''
+        if not self.resume_path:
+            return False
+        try:
+            with open(self.resume_path) as f:
+                resume = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        files = [list(entry) for entry in self.storage.stat()]
+        if (resume.get("version") != RESUME_VERSION or
+                resume.get("piece_length") != self.piece_length or
+                resume.get("total_length") != self.total_length or
+                resume.get("files") != files):
+            return False
+
+        for piece_idx in Bitfield(self.num_pieces, bytes.fromhex(resume["completed"])):
+            self._mark_complete(piece_idx)
+
+        for key, received in resume["partial"].items():
+            piece = self.pieces.get(int(key))
+            received = bytes.fromhex(received)
+            if piece is None or piece.is_complete or len(received) != piece.num_blocks:
+                continue
+            piece.buffer = bytearray(piece.length)
+            base = piece.idx * self.piece_length
+            for block_idx, has_block in enumerate(received):
+                if has_block:
+                    start = block_idx * self.block_size
+                    length = piece.block_length(block_idx)
+                    self.storage.readinto(base + start, memoryview(piece.buffer)[start:start + length])
+                    piece.block_states[block_idx] = BLOCK_RECEIVED
+                    piece.received_blocks += 1
+                    piece.saved.add(block_idx)
+                    self.unrequested_blocks -= 1
+            if piece.received_blocks == piece.num_blocks:
+                # never verified; let it be downloaded again
+                self._reset_piece(piece)
+            self._feed_hasher(piece)
+            self.active_pieces[piece.idx] = None
+        return True
+
+    async def recheck(self, workers: Optional[int] = None) -> int:
+        '''
+        Verifies the data already on disk against the piece hashes. The file is
+        split into contiguous ranges of pieces, each read sequentially in large
+        chunks on the hashing threads (a session's torrents share them), or on
+        a pool of workers threads when hashing runs on the event loop. Meant
+        to run before downloading starts. Returns the number of valid pieces.
+        '''
+        if not self.num_pieces:
+            return 0
+        workers = workers or os.cpu_count() or 1
+        pieces_per_read = max(1, RECHECK_READ_SIZE // self.piece_length)
+        ranges_count = min(self.num_pieces, workers * 4)
+        step = (self.num_pieces + ranges_count - 1) // ranges_count
+
+        def check_range(first: int, last: int) -> List[int]:
+            valid = []
+            chunk = bytearray(pieces_per_read * self.piece_length)
+            view = memoryview(chunk)
+            for chunk_first in range(first, last, pieces_per_read):
+                chunk_last = min(last, chunk_first + pieces_per_read)
+                wanted = sum(self.pieces[idx].length for idx in range(chunk_first, chunk_last))
+                got = self.storage.readinto(chunk_first * self.piece_length, view[:wanted])
+                offset = 0
+                for idx in range(chunk_first, chunk_last):
+                    piece = self.pieces[idx]
+                    if offset + piece.length <= got and hashlib.sha1(view[offset:offset + piece.length]).digest() == piece.hash:
+                        valid.append(idx)
+                    offset += piece.length
+            return valid
+
+        loop = asyncio.get_running_loop()
+        pool = self.hash_executor or ThreadPoolExecutor(max_workers=workers, thread_name_prefix="recheck")
+        try:
+            results = await asyncio.gather(*(
+                loop.run_in_executor(pool, check_range, first, min(self.num_pieces, first + step))
+                for first in range(0, self.num_pieces, step)
+            ))
+        finally:
+            if pool is not self.hash_executor:
+                pool.shutdown()
+
+        for valid in results:
+            for piece_idx in valid:
+                self._mark_complete(piece_idx)
+        return self.have.count
 
     def get_bitfield(self) -> bytes:
-        bitfield_length = (self.num_pieces + 7) // 8
-        bitfield = bytearray(bitfield_length)
-        for piece_idx in self.completed_pieces:
-            byte_idx = piece_idx // 8
-            bit_idx = 7 - (piece_idx % 8)
-            bitfield[byte_idx] |= (1 << bit_idx)
-        return bytes(bitfield)
-
-    def select_blocks(self, peer_bitfield: bytes, num_blocks: int = 1) -> List[Block]:
+        if self._bitfield_bytes is None:
+            self._bitfield_bytes = self.have.to_bytes()
+        return self._bitfield_bytes
+
+    def is_interesting(self, peer_bitfield: Bitfield) -> bool:
+        '''Whether the peer has any piece we still need.'''
+        return peer_bitfield.any_not_in(self.have)
+
+    def _candidate_pieces(self, peer_bitfield: Bitfield) -> Iterator[int]:
+        yield from list(self.active_pieces)
+        random_first = self.have.count < RANDOM_FIRST_PIECES
+        for piece_idx in self.picker.pieces(peer_bitfield, random_order=random_first):
+            if piece_idx not in self.active_pieces:
+                yield piece_idx
+
+    def select_blocks(self, peer_bitfield: Bitfield, num_blocks: int = 1) -> List[Block]:
         selected_blocks = []
         try:
-            for piece_idx in range(self.num_pieces):
-                if piece_idx in self.completed_pieces:
+            for piece_idx in self._candidate_pieces(peer_bitfield):
+                if piece_idx not in peer_bitfield:
                     continue
-                    
-                byte_idx = piece_idx // 8
-                bit_idx = 7 - (piece_idx % 8)
-                
-                if byte_idx < len(peer_bitfield) and peer_bitfield[byte_idx] & (1 << bit_idx):
-                    piece = self.pieces[piece_idx]
-                    offset = piece.received_blocks * self.block_size
-                    
-                    if offset >= piece.length or offset in self.pending_blocks[piece_idx]:
-                        continue
-                        
-                    block_length = min(self.block_size, piece.length - offset)
-                    if block_length <= 0:
-                        continue
-                        
-                    selected_blocks.append(Block(piece_idx, offset, block_length))
-                    self.pending_blocks[piece_idx].add(offset)
-                    
-                    if len(selected_blocks) >= num_blocks:
-                        break
+
+                piece = self.pieces[piece_idx]
+                if piece.is_complete:
+                    continue
+
+                block_idx = piece.block_states.find(BLOCK_MISSING)
+                while block_idx != -1 and len(selected_blocks) < num_blocks:
+                    piece.block_states[block_idx] = BLOCK_REQUESTED
+                    self.unrequested_blocks -= 1
+                    selected_blocks.append(Block(piece_idx, block_idx * self.block_size, piece.block_length(block_idx)))
+                    block_idx = piece.block_states.find(BLOCK_MISSING, block_idx + 1)
+
+                if piece.buffer is None:
+                    piece.buffer = bytearray(piece.length)
+                self.active_pieces[piece_idx] = None
+
+                if len(selected_blocks) >= num_blocks:
+                    break
         except Exception as e:
             print(f"Error in select_blocks: {e}")
             return []
                         
         return selected_blocks
 
-    async def recv_block(self, piece_idx: int, offset: int, data: bytes) -> None:
-        if piece_idx not in self.pieces:
+    def cancel_block(self, piece_idx: int, offset: int) -> None:
+        piece = self.pieces.get(piece_idx)
+        if piece is None or piece.is_complete:
             return
+        block_idx = offset // self.block_size
+        if block_idx < piece.num_blocks and piece.block_states[block_idx] == BLOCK_REQUESTED:
+            piece.block_states[block_idx] = BLOCK_MISSING
+            self.unrequested_blocks += 1
 
-        piece = self.pieces[piece_idx]
-        if piece.is_complete or offset in piece.blocks:
-            return
+    @property
+    def in_endgame(self) -> bool:
+        return self.unrequested_blocks == 0 and not self.have.complete
+
+    def select_endgame_blocks(self, peer_bitfield: Bitfield, exclude: Set[tuple], num_blocks: int) -> List[Block]:
+        '''
+        In endgame every missing block is already requested from someone;
+        this hands out those outstanding blocks again, skipping the ones in
+        exclude (already requested from this peer). Block states are unchanged.
+        '''
+        selected_blocks = []
+        for piece_idx in list(self.active_pieces):
+            piece = self.pieces[piece_idx]
+            if piece.is_complete or piece_idx not in peer_bitfield:
+                continue
+            block_idx = piece.block_states.find(BLOCK_REQUESTED)
+            while block_idx != -1:
+                offset = block_idx * self.block_size
+                if (piece_idx, offset) not in exclude:
+                    selected_blocks.append(Block(piece_idx, offset, piece.block_length(block_idx)))
+                    if len(selected_blocks) >= num_blocks:
+                        return selected_blocks
+                block_idx = piece.block_states.find(BLOCK_REQUESTED, block_idx + 1)
+        return selected_blocks
+
+    def _wanted_block(self, piece_idx: int, offset: int, length: int) -> Optional[Piece]:
+        piece = self.pieces.get(piece_idx)
+        if piece is None or piece.is_complete:
+            return None
+        block_idx, rem = divmod(offset, self.block_size)
+        if rem or block_idx >= piece.num_blocks or length != piece.block_length(block_idx):
+            return None
+        if piece.block_states[block_idx] == BLOCK_RECEIVED:
+            return None
+        return piece
 
-        piece.blocks[offset] = data
+    def block_buffer(self, piece_idx: int, offset: int, length: int, owner) -> Optional[memoryview]:
+        '''
+        Where the wire protocol should receive a block: its slot in the piece
+        buffer, or None if the block is not wanted or another connection is
+        already receiving it (it is then read as a normal message into the
+        connection's own buffer). The owner must follow up with block_written
+        once the data is in place, or block_abandoned if it never arrives.
+        '''
+        piece = self._wanted_block(piece_idx, offset, length)
+        if piece is None or piece.buffer is None or piece.received_blocks == piece.num_blocks:
+            return None
+        block_idx = offset // self.block_size
+        if block_idx in piece.receivers:
+            return None
+        piece.receivers[block_idx] = owner
+        return memoryview(piece.buffer)[offset:offset + length]
+
+    def _release_slot(self, piece: Piece, offset: int, owner) -> bool:
+        '''Gives up owner's claim on the block's slot; False if the slot was not (or no longer) its.'''
+        block_idx = offset // self.block_size
+        if piece.receivers.get(block_idx) is not owner:
+            return False
+        del piece.receivers[block_idx]
+        return True
+
+    def block_abandoned(self, piece_idx: int, offset: int, owner) -> None:
+        piece = self.pieces.get(piece_idx)
+        if piece is not None:
+            self._release_slot(piece, offset, owner)
+
+    def release_blocks(self, owner) -> None:
+        '''Drops every slot a closed connection was still receiving into.'''
+        for piece_idx in list(self.active_pieces):
+            receivers = self.pieces[piece_idx].receivers
+            for block_idx in [b for b, o in receivers.items() if o is owner]:
+                del receivers[block_idx]
+
+    async def block_written(self, piece_idx: int, offset: int, length: int, source: Optional[str] = None,
+                            owner=None) -> bool:
+        '''Returns whether the block was taken into its piece, as recv_block does.'''
+        piece = self.pieces.get(piece_idx)
+        if piece is None:
+            self.bytes_wasted += length
+            return False
+        # a block whose slot was taken over by another connection went to the owner's scratch space
+        if self._release_slot(piece, offset, owner) and self._wanted_block(piece_idx, offset, length) is not None:
+            await self._block_arrived(piece, offset, length, source)
+            return True
+        self.bytes_wasted += length
+        return False
+
+    async def recv_block(self, piece_idx: int, offset: int, data: bytes, source: Optional[str] = None) -> bool:
+        '''Stores a block; returns False if it was not wanted (a duplicate, unrequested or malformed).'''
+        piece = self._wanted_block(piece_idx, offset, len(data))
+        if piece is None or piece.received_blocks == piece.num_blocks:
+            # a duplicate (endgame) or unrequested block
+            self.bytes_wasted += len(data)
+            return False
+
+        if piece.buffer is None:
+            piece.buffer = bytearray(piece.length)
+            self.active_pieces[piece_idx] = None
+        # this copy wins; the rest of a connection still receiving the block goes to its scratch space
+        owner = piece.receivers.pop(offset // self.block_size, None)
+        if owner is not None:
+            owner.divert_piece(piece_idx, offset)
+        piece.buffer[offset:offset + len(data)] = data
+        await self._block_arrived(piece, offset, len(data), source)
+        return True
+
+    async def _block_arrived(self, piece: Piece, offset: int, length: int, source: Optional[str] = None) -> None:
+        piece_idx = piece.idx
+        block_idx = offset // self.block_size
+        if piece.block_states[block_idx] == BLOCK_MISSING:
+            self.unrequested_blocks -= 1
+        piece.block_states[block_idx] = BLOCK_RECEIVED
         piece.received_blocks += 1
-        self.total_downloaded += len(data)
-        self.pending_blocks[piece_idx].discard(offset)
-
-        if len(piece.blocks) * self.block_size >= piece.length:
-            piece_data = b''.join(piece.blocks[offset] for offset in sorted(piece.blocks.keys()))
-            if hashlib.sha1(piece_data).digest() == piece.hash:
-                piece.is_complete = True
-                self.completed_pieces.add(piece_idx)
-                for offset in piece.blocks.keys():
-                    piece.blocks[offset] = None
-                
-                await self.write_piece(piece_idx, piece_data)
+        self.total_downloaded += length
+        if source is not None:
+            piece.sources.add(source)
+
+        if piece.received_blocks < piece.num_blocks:
+            if block_idx == piece.hashed_blocks:
+                self._feed_hasher(piece)
+        else:
+            if await self._piece_digest(piece) == piece.hash:
+                # the cache takes the buffer as is and get_block serves the piece from it until it
+                # is flushed; no connection can still write into it, as every block has arrived
+                # and slots are only owned by blocks that have not
+                try:
+                    await self.write_piece(piece_idx, piece.buffer)
+                except OSError as e:
+                    print(f"Error writing piece {piece_idx}: {e}")
+                    self._reset_piece(piece)
+                    return
+                self._mark_complete(piece_idx)
+                if self.have.complete:
+                    await self.write_cache.flush()
 
                 if self.on_piece_complete:
                     await self.on_piece_complete(piece_idx)
             else:
-                piece.blocks.clear()
-                piece.received_blocks = 0
-                self.pending_blocks[piece_idx].clear()
-
-    async def write_piece(self, piece_idx: int, data: bytes) -> None:
-        def blocking_io():
-            self.file_handle.seek(piece_idx * self.piece_length)
-            self.file_handle.write(data)
-            self.file_handle.flush()
-        await asyncio.to_thread(blocking_io)
-
-    def get_block(self, index: int, begin: int, length: int) -> Optional[bytes]:
+                sources = piece.sources
+                self.hash_failures += 1
+                self.bytes_wasted += piece.length
+                self._reset_piece(piece)
+                if self.on_hash_failure:
+                    self.on_hash_failure(piece_idx, sources)
+
+    def _feed_hasher(self, piece: Piece) -> None:
+        '''Hashes the newly contiguous run of received blocks, one block at a time.'''
+        buffer = memoryview(piece.buffer)
+        while piece.hashed_blocks < piece.num_blocks and piece.block_states[piece.hashed_blocks] == BLOCK_RECEIVED:
+            start = piece.hashed_blocks * self.block_size
+            piece.hasher.update(buffer[start:start + piece.block_length(piece.hashed_blocks)])
+            piece.hashed_blocks += 1
+
+    async def _piece_digest(self, piece: Piece) -> bytes:
+        start = piece.hashed_blocks * self.block_size
+        if start >= piece.length or self.hash_executor is None:
+            piece.hasher.update(memoryview(piece.buffer)[start:])
+            return piece.hasher.digest()
+
+        def finish_hash():
+            began = time.perf_counter()
+            piece.hasher.update(memoryview(piece.buffer)[start:])
+            return piece.hasher.digest(), time.perf_counter() - began
+
+        digest, elapsed = await asyncio.get_running_loop().run_in_executor(self.hash_executor, finish_hash)
+        self.hash_time_offloaded += elapsed
+        return digest
+
+    async def write_piece(self, piece_idx: int, data) -> None:
+        await self.write_cache.put(piece_idx, data)
+
+    async def get_block(self, index: int, begin: int, length: int) -> Optional[memoryview]:
+        '''Returns a view of the block, sliced without copying where possible.'''
         if not (0 <= index < self.num_pieces and 
-                0 <= begin < self.piece_length and 
-                0 < length <= self.piece_length - begin):
+                0 <= begin < self.pieces[index].length and 
+                0 < length <= self.pieces[index].length - begin):
             return None
             
-        if index not in self.completed_pieces:
+        if index not in self.have:
             return None
             
-        self.file_handle.seek(index * self.piece_length + begin)
-        data = self.file_handle.read(length)
+        offset = index * self.piece_length + begin
+        cached = self.write_cache.get(index)
+        data = None
+        if cached is not None:
+            data = memoryview(cached)[begin:begin + length]
+        elif self.upload_mode == UPLOAD_MMAP:
+            data = self.storage.map_view(offset, length)
+        if data is None:
+            if self.read_cache is not None:
+                data = memoryview(await self.read_cache.get(index))[begin:begin + length]
+            else:
+                data = memoryview(await self.disk.read(self.storage, offset, length))
         if data:
             self.total_uploaded += len(data)
         return data
 
+    async def read_piece(self, piece_idx: int) -> bytes:
+        return await self.disk.read(self.storage, piece_idx * self.piece_length, self.pieces[piece_idx].length)
+
+    async def close(self) -> None:
+        await self.write_cache.close()
+        await self.save_resume()
+
     def get_metrics(self) -> dict:
-        completed_length = len(self.completed_pieces) * self.piece_length
-        if self.completed_pieces and max(self.completed_pieces) == self.num_pieces - 1:
-            completed_length = completed_length - self.piece_length + self.pieces[self.num_pieces - 1].length
-        left = max(0, self.total_length - completed_length)
         return {
             "uploaded": self.total_uploaded,
             "downloaded": self.total_downloaded,
-            "left": left
+            "left": self.total_length - self.bytes_verified,
+            "verified": self.bytes_verified,
+            "wasted": self.bytes_wasted,
+            "hash_failures": self.hash_failures,
+            "hash_time_offloaded": self.hash_time_offloaded,
+            "read_cache_hits": self.read_cache.hits if self.read_cache else 0,
+            "read_cache_misses": self.read_cache.misses if self.read_cache else 0
         }
\ No newline at end of file
@@ -0,0 +1,79 @@
+import math
+import time
+from typing import Optional
+
+class RateMeter:
+    '''
+    Counts bytes into one-second buckets kept in a fixed ring. rate() is the
+    sliding-window average over the last `window` seconds and average() is an
+    EWMA of the per-second samples, which reacts faster. Both are O(1) except
+    when rolling over idle seconds, which touches at most `window` buckets.
+    Bytes added to a meter are also added to its parent, so per-peer meters
+    feed the per-torrent meter, which feeds the global one.
+    '''
+    __slots__ = ("window", "buckets", "alpha", "parent", "total", "window_sum", "ewma", "started", "second")
+
+    def __init__(self, window: int = 20, ewma_seconds: float = 5.0, parent: Optional["RateMeter"] = None):
+        self.window = window
+        self.buckets = [0] * window
+        self.alpha = 1 - math.exp(-1 / ewma_seconds)
+        self.parent = parent
+        self.total = 0
+        self.window_sum = 0
+        self.ewma = 0.0
+        self.started = time.monotonic()
+        self.second = int(self.started)
+
+    def _advance(self, second: int):
+        gap = second - self.second
+        if gap <= 0:
+            return
+        # the finished second is one sample; idle seconds after it are zero samples
+        self.ewma += self.alpha * (self.buckets[self.second % self.window] - self.ewma)
+        if gap > 1:
+            self.ewma *= (1 - self.alpha) ** (gap - 1)
+        for s in range(self.second + 1, self.second + 1 + min(gap, self.window)):
+            i = s % self.window
+            self.window_sum -= self.buckets[i]
+            self.buckets[i] = 0
+        self.second = second
+
+    def add(self, nbytes: int, now: Optional[float] = None):
+        if now is None:
+            now = time.monotonic()
+        self._advance(int(now))
+        self.buckets[self.second % self.window] += nbytes
+        self.window_sum += nbytes
+        self.total += nbytes
+        if self.parent is not None:
+            self.parent.add(nbytes, now)
+
+    def rate(self, now: Optional[float] = None) -> float:
+        '''Bytes per second over the sliding window, including the current partial second.'''
+        if now is None:
+            now = time.monotonic()
+        self._advance(int(now))
+        span = min(self.window - 1 + (now - self.second), now - self.started)
+        return self.window_sum / max(span, 1.0)
+
+    def average(self, now: Optional[float] = None) -> float:
+        '''EWMA of completed one-second samples in bytes per second.'''
+        self._advance(int(time.monotonic() if now is None else now))
+        return self.ewma
+
+class TransferMeters:
+    '''A download and an upload meter, chained to a parent pair.'''
+    def __init__(self, parent: Optional["TransferMeters"] = None):
+        self.download = RateMeter(parent=parent.download if parent else None)
+        self.upload = RateMeter(parent=parent.upload if parent else None)
+
+    def snapshot(self) -> dict:
+        return {
+            "download_rate": self.download.rate(),
+            "upload_rate": self.upload.rate(),
+            "downloaded": self.download.total,
+            "uploaded": self.upload.total,
+        }
+
+# totals across every torrent in the process
+GLOBAL_METERS = TransferMeters()
@@ -0,0 +1,106 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from connection_manager import ConnectionBudget
+from disk_io import DiskEngine
+from limiter import BandwidthLimits
+from message import Handshake
+from peer_manager import RequestBudget
+from piece_manager import PieceManager
+from rate import GLOBAL_METERS
+from torrent_client import TorrentClient
+from wire import WireProtocol, WireWriter
+
+class Session:
+    '''
+    Runs any number of torrents behind one listening socket. Incoming
+    connections are handed to the torrent named by the info_hash in their
+    handshake, and all torrents share one disk engine, one pool of hashing
+    threads, the bandwidth limits, a ConnectionBudget and a RequestBudget,
+    so adding a torrent costs tasks rather than threads, sockets or a
+    process, and does not raise the session's caps.
+    '''
+    def __init__(self, my_id: str, listen_port: int, disk: Optional[DiskEngine] = None,
+                 limits: Optional[BandwidthLimits] = None, budget: Optional[ConnectionBudget] = None,
+                 hash_workers: int = 2, requests: Optional[RequestBudget] = None):
+        self.my_id = my_id
+        self.port = listen_port
+        self.disk = disk or DiskEngine()
+        self.limits = limits or BandwidthLimits()
+        self.budget = budget or ConnectionBudget()
+        self.requests = requests or RequestBudget()
+        self.hash_executor = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix="hash") if hash_workers > 0 else None
+        self.torrents: Dict[bytes, TorrentClient] = {}
+        self.tasks: Dict[bytes, asyncio.Task] = {}
+        self.server = None
+
+    def add_torrent(self, info_hash: bytes, piece_manager: PieceManager, peer_list: List) -> TorrentClient:
+        '''Starts a torrent; its piece manager should use the session's disk and hash_executor.'''
+        if info_hash in self.torrents:
+            raise ValueError(f"torrent {info_hash.hex()} is already in the session")
+        client = TorrentClient(info_hash, self.my_id, piece_manager, self.port, limits=self.limits, budget=self.budget,
+                               requests=self.requests)
+        self.torrents[info_hash] = client
+        self.tasks[info_hash] = asyncio.create_task(client.run(peer_list, listen=False))
+        return client
+
+    async def remove_torrent(self, info_hash: bytes):
+        '''Stops a torrent and disconnects its peers; closing its piece manager is left to the caller.'''
+        self.torrents.pop(info_hash, None)
+        task = self.tasks.pop(info_hash, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.wait([task])
+
+    async def handle_incoming_connection(self, reader: WireProtocol, writer: WireWriter):
+        try:
+            handshake = Handshake.decode(await reader.read_handshake())
+        except Exception as e:
+            print(f"Error reading incoming handshake: {e}")
+            writer.close()
+            return
+        client = self.torrents.get(handshake.info_hash)
+        if client is None:
+            writer.close()
+            return
+        await client.handle_incoming_connection(reader, writer, handshake)
+
+    async def run(self):
+        self.server = await asyncio.get_running_loop().create_server(
+            lambda: WireProtocol(self.handle_incoming_connection),
+            host='0.0.0.0',
+            port=self.port
+        )
+        async with self.server:
+            await self.server.serve_forever()
+
+    def get_stats(self) -> dict:
+        '''Session totals plus a summary of each torrent, keyed by hex info_hash.'''
+        stats = GLOBAL_METERS.snapshot()
+        stats["connections"] = self.budget.connections
+        stats["half_open"] = self.budget.half_open
+        stats["inflight_requests"] = self.requests.inflight
+        stats["torrents"] = {
+            info_hash.hex(): dict(
+                client.peer_manager.meters.snapshot(),
+                left=client.pieceManager.get_metrics()["left"],
+                peers=len(client.peerObjects),
+            )
+            for info_hash, client in self.torrents.items()
+        }
+        return stats
+
+    def set_rate_limits(self, **limits):
+        '''Changes the session-wide limits; see BandwidthLimits.set_limits.'''
+        self.limits.set_limits(**limits)
+
+    async def close(self):
+        for info_hash in list(self.torrents):
+            await self.remove_torrent(info_hash)
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        self.disk.close()
+        if self.hash_executor is not None:
+            self.hash_executor.shutdown(wait=False)
@@ -0,0 +1,229 @@
+import asyncio
+import json
+import multiprocessing
+import socket
+import time
+from typing import Callable, Dict, List, Optional
+
+from session import Session
+from wire import WireProtocol
+
+# control messages are one SOCK_SEQPACKET datagram each, tagged by their first byte
+MSG_HANDOFF = b"H"  # supervisor -> worker: pre-read handshake, with the connection's fd attached
+MSG_STATS = b"S"    # worker -> supervisor: JSON of Session.get_stats()
+MAX_MESSAGE = 1024 * 1024
+STATS_INTERVAL = 2.0
+# an incoming connection must finish its handshake within this long to be routed
+HANDSHAKE_TIMEOUT = 10.0
+# fields summed over the workers in Supervisor.get_stats
+SUMMED_STATS = ("download_rate", "upload_rate", "downloaded", "uploaded", "connections", "half_open",
+                "inflight_requests")
+
+async def _read_handshake(sock: socket.socket) -> bytes:
+    '''Reads exactly one handshake, leaving whatever the peer sent after it in the socket for the worker.'''
+    loop = asyncio.get_running_loop()
+    data = b""
+    needed = 1
+    while len(data) < needed:
+        chunk = await loop.sock_recv(sock, needed - len(data))
+        if not chunk:
+            raise ConnectionResetError("connection closed during handshake")
+        data += chunk
+        if len(data) == 1:
+            # pstrlen, pstr, 8 reserved bytes, info_hash, peer_id
+            needed = 49 + data[0]
+    return data
+
+class _Worker:
+    def __init__(self, index: int, process: multiprocessing.process.BaseProcess, control: socket.socket):
+        self.index = index
+        self.process = process
+        self.control = control
+        self.send_lock = asyncio.Lock()
+        self.stats: dict = {}
+        self.alive = True
+
+    async def hand_off(self, sock: socket.socket, handshake: bytes):
+        loop = asyncio.get_running_loop()
+        # one sender at a time, so only one writer callback is ever registered for the socket
+        async with self.send_lock:
+            while True:
+                try:
+                    socket.send_fds(self.control, [MSG_HANDOFF + handshake], [sock.fileno()])
+                    return
+                except BlockingIOError:
+                    writable = loop.create_future()
+                    loop.add_writer(self.control, lambda: writable.done() or writable.set_result(None))
+                    try:
+                        await writable
+                    finally:
+                        loop.remove_writer(self.control)
+
+class Supervisor:
+    '''
+    Spreads torrents over worker processes, each running its own Session and
+    event loop, so hashing, parsing and choking scale with cores. The
+    supervisor owns the listening socket: it reads each incoming handshake,
+    looks up the worker owning that info_hash and passes the socket and the
+    handshake bytes to it over a Unix socket (SCM_RIGHTS). Workers report
+    their stats every STATS_INTERVAL, and get_stats() sums them.
+    '''
+    def __init__(self, listen_port: int):
+        self.port = listen_port
+        self.workers: List[_Worker] = []
+        self.routes: Dict[bytes, _Worker] = {}
+        self.listener: Optional[socket.socket] = None
+        self.tasks = set()
+        # spawn rather than fork, as the supervisor already runs an event loop
+        self.context = multiprocessing.get_context("spawn")
+
+    def add_worker(self, info_hashes: List[bytes], target: Callable, *args):
+        '''Starts target(*args, control_socket) in a new process and routes the info_hashes to it.'''
+        control, child_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        process = self.context.Process(target=target, args=(*args, child_control), daemon=True)
+        process.start()
+        child_control.close()
+        control.setblocking(False)
+        worker = _Worker(len(self.workers), process, control)
+        self.workers.append(worker)
+        for info_hash in info_hashes:
+            self.routes[info_hash] = worker
+
+    def _on_control(self, worker: _Worker):
+        while True:
+            try:
+                message = worker.control.recv(MAX_MESSAGE)
+            except BlockingIOError:
+                return
+            except OSError:
+                message = b""
+            if not message:
+                print(f"Shard worker {worker.index} exited")
+                worker.alive = False
+                asyncio.get_running_loop().remove_reader(worker.control)
+                return
+            if message[:1] == MSG_STATS:
+                worker.stats = json.loads(message[1:])
+
+    async def _route(self, sock: socket.socket):
+        try:
+            handshake = await asyncio.wait_for(_read_handshake(sock), HANDSHAKE_TIMEOUT)
+            offset = 1 + handshake[0] + 8
+            worker = self.routes.get(handshake[offset:offset + 20])
+            if worker is not None and worker.alive:
+                await worker.hand_off(sock, handshake)
+        except Exception as e:
+            print(f"Error routing incoming connection: {e}")
+        finally:
+            # the worker holds its own copy of the descriptor
+            sock.close()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for worker in self.workers:
+            loop.add_reader(worker.control, self._on_control, worker)
+        self.listener = socket.create_server(("0.0.0.0", self.port))
+        self.listener.setblocking(False)
+        while True:
+            sock, _ = await loop.sock_accept(self.listener)
+            sock.setblocking(False)
+            task = asyncio.create_task(self._route(sock))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def get_stats(self) -> dict:
+        '''Totals over all workers, and each worker's torrents merged into one dict.'''
+        stats = {field: 0 for field in SUMMED_STATS}
+        stats["torrents"] = {}
+        stats["workers"] = sum(worker.alive for worker in self.workers)
+        for worker in self.workers:
+            for field in SUMMED_STATS:
+                stats[field] += worker.stats.get(field, 0)
+            stats["torrents"].update(worker.stats.get("torrents", {}))
+        return stats
+
+    async def close(self, timeout: float = 30.0):
+        '''Asks the workers to shut down, which saves their resume data, and waits for them.'''
+        loop = asyncio.get_running_loop()
+        if self.listener is not None:
+            self.listener.close()
+        for worker in self.workers:
+            if worker.alive:
+                loop.remove_reader(worker.control)
+            worker.process.terminate()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            await loop.run_in_executor(None, worker.process.join, max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                worker.process.kill()
+            worker.control.close()
+
+class ShardWorker:
+    '''
+    The worker side of a Supervisor: adopts handed-off connections into the
+    Session as if it had accepted them, and reports the Session's stats.
+    '''
+    def __init__(self, session: Session, control: socket.socket):
+        self.session = session
+        self.control = control
+        self.control.setblocking(False)
+        self.stopped: Optional[asyncio.Future] = None
+        self.tasks = set()
+
+    def _on_control(self):
+        while True:
+            try:
+                message, fds, _, _ = socket.recv_fds(self.control, MAX_MESSAGE, 1)
+            except BlockingIOError:
+                return
+            except OSError:
+                message, fds = b"", []
+            if not message:
+                # the supervisor is gone; nothing more will be routed here
+                asyncio.get_running_loop().remove_reader(self.control)
+                self.stop()
+                return
+            if message[:1] == MSG_HANDOFF and fds:
+                sock = socket.socket(fileno=fds[0])
+                task = asyncio.create_task(self._adopt(sock, message[1:]))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            else:
+                for fd in fds:
+                    socket.close(fd)
+
+    async def _adopt(self, sock: socket.socket, handshake: bytes):
+        sock.setblocking(False)
+        # the handshake is parsed before connection_made starts the session's handler
+        protocol = WireProtocol(self.session.handle_incoming_connection)
+        protocol.feed(handshake)
+        try:
+            await asyncio.get_running_loop().connect_accepted_socket(lambda: protocol, sock)
+        except Exception as e:
+            print(f"Error adopting handed-off connection: {e}")
+            sock.close()
+
+    async def report_stats(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.sock_sendall(self.control, MSG_STATS + json.dumps(self.session.get_stats()).encode())
+            except Exception as e:
+                print(f"Error reporting shard stats: {e}")
+            await asyncio.sleep(STATS_INTERVAL)
+
+    def stop(self):
+        if self.stopped is not None and not self.stopped.done():
+            self.stopped.set_result(None)
+
+    async def run(self):
+        '''Runs until stop() or until the supervisor closes the control socket.'''
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        loop.add_reader(self.control, self._on_control)
+        reporter = asyncio.create_task(self.report_stats())
+        try:
+            await self.stopped
+        finally:
+            reporter.cancel()
+            loop.remove_reader(self.control)
@@ -0,0 +1,216 @@
+import mmap
+import os
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+OPEN_FLAGS = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+IOV_MAX = 1024
+
+def pwritev_all(fd: int, chunks: List[memoryview], offset: int) -> None:
+    for i in range(0, len(chunks), IOV_MAX):
+        group = chunks[i:i + IOV_MAX]
+        expected = sum(len(c) for c in group)
+        written = os.pwritev(fd, group, offset)
+        if written < expected:
+            # rare short write; finish the remainder in one piece
+            rest = memoryview(b"".join(group))[written:]
+            while rest:
+                k = os.pwrite(fd, rest, offset + written)
+                rest = rest[k:]
+                written += k
+        offset += expected
+
+@dataclass(frozen=True)
+class FileSpan:
+    path: str
+    offset: int # where the file starts in the torrent's concatenated data
+    length: int
+
+class FileHandlePool:
+    '''
+    Bounded LRU of open file descriptors keyed by path. A descriptor that is
+    in use by another thread is never closed, so the pool may briefly exceed
+    max_open under load.
+    '''
+    def __init__(self, max_open: int = 64):
+        self.max_open = max_open
+        self.handles: "OrderedDict[str, int]" = OrderedDict()
+        self.users: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, path: str) -> int:
+        with self.lock:
+            fd = self.handles.get(path)
+            if fd is None:
+                fd = os.open(path, OPEN_FLAGS, 0o644)
+                self.handles[path] = fd
+            else:
+                self.handles.move_to_end(path)
+            self.users[path] = self.users.get(path, 0) + 1
+            self._evict()
+            return fd
+
+    def release(self, path: str):
+        with self.lock:
+            self.users[path] -= 1
+            if not self.users[path]:
+                del self.users[path]
+            self._evict()
+
+    def _evict(self):
+        for path in list(self.handles):
+            if len(self.handles) <= self.max_open:
+                break
+            if path not in self.users:
+                os.close(self.handles.pop(path))
+
+    def close(self):
+        with self.lock:
+            for fd in self.handles.values():
+                os.close(fd)
+            self.handles.clear()
+
+class Storage:
+    '''
+    Maps offsets in the torrent's concatenated data onto the files that make
+    it up. Span start offsets are kept sorted so the first file touched by an
+    access is found with a bisect; accesses crossing file boundaries are split
+    into one positional read or write per file.
+    '''
+    def __init__(self, root: str, files: List[Tuple[str, int]], max_open_files: int = 64):
+        self.root = root
+        self.spans: List[FileSpan] = []
+        offset = 0
+        for rel_path, length in files:
+            self.spans.append(FileSpan(os.path.join(root, rel_path), offset, length))
+            offset += length
+        self.span_starts = [span.offset for span in self.spans]
+        self.total_length = offset
+        self.pool = FileHandlePool(max_open_files)
+        self.dirty: Set[str] = set()
+        # read-only maps used by the zero-copy upload path, bounded like the handle pool
+        self.maps: "OrderedDict[str, mmap.mmap]" = OrderedDict()
+        self.max_maps = max_open_files
+        self.had_existing_data = False
+
+        for span in self.spans:
+            os.makedirs(os.path.dirname(span.path) or ".", exist_ok=True)
+            exists = os.path.exists(span.path)
+            size = os.path.getsize(span.path) if exists else -1
+            self.had_existing_data |= size > 0
+            if size != span.length:
+                # only resize when needed; truncating bumps mtime, which invalidates resume data
+                with open(span.path, "r+b" if exists else "wb") as f:
+                    f.truncate(span.length)
+
+    def locate(self, offset: int, length: int) -> Iterator[Tuple[FileSpan, int, int]]:
+        '''Yields (span, offset within file, length) for each file touched by the range.'''
+        end = offset + length
+        i = max(0, bisect_right(self.span_starts, offset) - 1)
+        while offset < end and i < len(self.spans):
+            span = self.spans[i]
+            i += 1
+            span_end = span.offset + span.length
+            if offset >= span_end:
+                continue
+            n = min(end, span_end) - offset
+            yield span, offset - span.offset, n
+            offset += n
+
+    def write(self, offset: int, data) -> None:
+        self.writev(offset, [data])
+
+    def writev(self, offset: int, buffers: Sequence) -> None:
+        '''Writes buffers back to back starting at offset, one pwritev per file touched.'''
+        views = [memoryview(b).cast("B") for b in buffers]
+        total = sum(len(v) for v in views)
+        buf_idx, buf_pos = 0, 0
+        for span, file_offset, n in self.locate(offset, total):
+            # slice the incoming buffers to exactly the bytes that belong to this file
+            chunks = []
+            need = n
+            while need:
+                view = views[buf_idx]
+                take = min(need, len(view) - buf_pos)
+                chunks.append(view[buf_pos:buf_pos + take])
+                need -= take
+                buf_pos += take
+                if buf_pos == len(view):
+                    buf_idx, buf_pos = buf_idx + 1, 0
+            fd = self.pool.acquire(span.path)
+            try:
+                pwritev_all(fd, chunks, file_offset)
+            finally:
+                self.pool.release(span.path)
+            self.dirty.add(span.path)
+
+    def readinto(self, offset: int, buffer) -> int:
+        view = memoryview(buffer)
+        pos = 0
+        for span, file_offset, n in self.locate(offset, len(view)):
+            fd = self.pool.acquire(span.path)
+            try:
+                got = os.preadv(fd, [view[pos:pos + n]], file_offset)
+            finally:
+                self.pool.release(span.path)
+            pos += got
+            if got < n:
+                break
+        return pos
+
+    def read(self, offset: int, length: int) -> bytes:
+        buffer = bytearray(length)
+        n = self.readinto(offset, buffer)
+        return bytes(buffer[:n]) if n < length else bytes(buffer)
+
+    def map_view(self, offset: int, length: int) -> Optional[memoryview]:
+        '''
+        Returns a memoryview into a read-only mmap of the file holding the range,
+        or None if the range crosses a file boundary.
+        '''
+        located = list(self.locate(offset, length))
+        if len(located) != 1:
+            return None
+        span, file_offset, n = located[0]
+        m = self.maps.get(span.path)
+        if m is None:
+            fd = self.pool.acquire(span.path)
+            try:
+                m = mmap.mmap(fd, span.length, access=mmap.ACCESS_READ)
+            finally:
+                self.pool.release(span.path)
+            self.maps[span.path] = m
+            if len(self.maps) > self.max_maps:
+                # evicted maps are unmapped once no views into them remain
+                self.maps.popitem(last=False)
+        else:
+            self.maps.move_to_end(span.path)
+        if hasattr(mmap, "MADV_WILLNEED"):
+            start = file_offset - file_offset % mmap.PAGESIZE
+            m.madvise(mmap.MADV_WILLNEED, start, file_offset + n - start)
+        return memoryview(m)[file_offset:file_offset + n]
+
+    def stat(self) -> List[Tuple[int, int]]:
+        '''(size, mtime_ns) of every file, used to validate resume data.'''
+        result = []
+        for span in self.spans:
+            st = os.stat(span.path)
+            result.append((st.st_size, st.st_mtime_ns))
+        return result
+
+    def sync(self) -> None:
+        '''fsyncs every file written since the last sync.'''
+        for path in list(self.dirty):
+            fd = self.pool.acquire(path)
+            try:
+                os.fsync(fd)
+            finally:
+                self.pool.release(path)
+            self.dirty.discard(path)
+
+    def close(self) -> None:
+        self.maps.clear()
+        self.pool.close()
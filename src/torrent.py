@@ -1,6 +1,8 @@
 # encoder: https://pypi.org/project/bencode.py/
 import bencodepy as b
 import hashlib
+import os
+import random
 from urllib.parse import urlparse, urlunparse
 
 class Torrent:
@@ -18,13 +20,39 @@ class Torrent:
         # begin reading and filling instance vars
         file_content = b.decode(content)
         self.info = file_content[b'info']
-        self.tracker_url_parse = urlparse(file_content[b'announce'].decode('utf-8'))
+        # BEP 12: tiers of tracker URLs, each tier shuffled once; a plain announce is a single tier
+        self.tracker_tiers = []
+        for tier in file_content.get(b'announce-list', []):
+            urls = [url.decode('utf-8') for url in tier]
+            random.shuffle(urls)
+            if urls:
+                self.tracker_tiers.append(urls)
+        if b'announce' in file_content:
+            announce = file_content[b'announce'].decode('utf-8')
+        else:
+            announce = self.tracker_tiers[0][0]
+        if not self.tracker_tiers:
+            self.tracker_tiers = [[announce]]
+        self.tracker_url_parse = urlparse(announce)
         self.tracker_base_url = self.tracker_url_parse.netloc.split(":")[0]
         self.tracker_port = 6969 if len(self.tracker_url_parse.netloc.split(":")) == 1 else  int(self.tracker_url_parse.netloc.split(":")[-1])
         
         self.piece_len = self.info[b'piece length']
-        self.filename = self.info[b'name'].decode('utf-8')
-        self.file_len = self.info[b'length'] if b'length' in self.info.keys() else self.info[b'files'][0][b'length']
+        # the name becomes a file or folder under the download folder, so it must be one plain component
+        name = self.safePath([self.info[b'name']])
+        self.filename = name[0] if name else self.getInfoHash().hex()
+        # (relative path, length) for every file, in the order their data is concatenated
+        if b'files' in self.info:
+            self.files = []
+            for f in self.info[b'files']:
+                parts = self.safePath(f[b'path'])
+                if not parts:
+                    # would collapse onto the torrent's folder itself
+                    raise ValueError(f"invalid file path {f[b'path']!r} in torrent")
+                self.files.append((os.path.join(self.filename, *parts), f[b'length']))
+        else:
+            self.files = [(self.filename, self.info[b'length'])]
+        self.file_len = sum(length for _, length in self.files)
         
         # fill with SHA-1 hash values of each piece, NOT 
         pieces_str = self.info[b'pieces']
@@ -58,6 +86,15 @@ class Torrent:
     def getFileSize(self):
         return self.file_len
 
+    # return (relative path, length) of each file in the torrent
+    def getFiles(self):
+        return self.files
+
+    # drop path components that could escape the download folder
+    @staticmethod
+    def safePath(parts):
+        return [p.decode('utf-8') for p in parts if p not in (b'', b'.', b'..') and b'/' not in p and b'\\' not in p]
+
     # returns the URL for the tracker we need to contact
     def getTrackerURL(self):
         # return self.tracker_base_url
@@ -66,6 +103,9 @@ class Torrent:
     def getInfoHash(self):
         return hashlib.sha1(b.encode(self.info)).digest()
 
+    def getTrackerTiers(self):
+        return self.tracker_tiers
+
     def getTrackerPort(self):
         return self.tracker_port
     
@@ -73,6 +113,9 @@ class Torrent:
         return self.pieces
     
     def canScrape(self):
+        # every UDP tracker supports scrape (BEP 15)
+        if self.tracker_url_parse.scheme == "udp":
+            return True
         path = self.tracker_url_parse.path
 
         # Find the last slash in the path
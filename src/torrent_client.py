@@ -1,17 +1,22 @@
 import asyncio
 import sys
-from typing import List, Dict
-from peer_manager import PeerManager
+from typing import Callable, List, Dict, Optional, Tuple
+from choker import RECHOKE_INTERVAL, Choker
+from connection_manager import ConnectionBudget, ConnectionManager
+from limiter import BandwidthLimits
+from peer_manager import PeerManager, RequestBudget
 from message import Handshake, MessageType, Have
 from peer import Peer
 from piece_manager import PieceManager
-import random
+from wire import WireProtocol, WireWriter
 class TorrentClient:
-    def __init__(self, info_hash: bytes, my_id: str, pieceManager: PieceManager, listen_port: int):
+    def __init__(self, info_hash: bytes, my_id: str, pieceManager: PieceManager, listen_port: int,
+                 limits: Optional[BandwidthLimits] = None, budget: Optional[ConnectionBudget] = None,
+                 requests: Optional[RequestBudget] = None):
         self.info_hash = info_hash
         self.my_id = my_id
         self.pieceManager = pieceManager
-        self.peer_manager = PeerManager(pieceManager)
+        self.peer_manager = PeerManager(pieceManager, limits=limits, requests=requests)
         self.peer_connections: Dict[str, asyncio.Task] = {}
         self.peerObjects: Dict[str, Peer] = {}
         self.MAX_UNCHOKED_PEERS = 8
@@ -19,15 +24,21 @@ class TorrentClient:
         self.port = listen_port
         self.server = None
         self.pieceManager.on_piece_complete = self.broadcast_have
+        self.choker = Choker(self.peer_manager.peers, max_slots=self.MAX_UNCHOKED_PEERS)
+        self.choke_wakeup = asyncio.Event()
+        self.peer_manager.on_peer_interested = lambda _: self.choke_wakeup.set()
+        self.connections = ConnectionManager(self.dial_peer, self.remove_peer, budget=budget)
+        self.pieceManager.on_hash_failure = self.connections.hash_failed
 
     async def remove_peer(self, peer_id: str):
-        if peer_id in self.peer_connections:
-            self.peer_connections[peer_id].cancel()
+        # popped first, as the connection's done callback calls remove_peer as well
+        task = self.peer_connections.pop(peer_id, None)
+        if task is not None:
+            task.cancel()
             try:
-                await self.peer_connections[peer_id]
+                await task
             except:
                 pass
-            del self.peer_connections[peer_id]
         if peer_id in self.peerObjects:
             peer = self.peerObjects[peer_id]
             if peer.writer:
@@ -49,73 +60,72 @@ class TorrentClient:
                     await self.remove_peer(peer_id)
 
     async def start_downloading(self, peer_list: List):
-        for p in peer_list:
-            ip, port, peer_id = p[0], p[1], p[2]
-            
-            if peer_id and peer_id in self.peer_connections:
-                await self.remove_peer(peer_id)
-                
-            peer = Peer(self.info_hash, self.my_id, self.peer_manager)
-            peer.peer_id = peer_id
+        # the connection manager dials the best candidates as slots free up
+        self.connections.add_candidates(peer_list)
+
+    async def dial_peer(self, ip: str, port: int, on_handshake: Callable[[str], bool]) -> Tuple[bool, int]:
+        '''Runs one outgoing connection; returns (handshake completed, bytes the peer delivered).'''
+        peer = Peer(self.info_hash, self.my_id, self.peer_manager)
+        task = None
+
+        def handshake(peer_id: str) -> bool:
+            if not on_handshake(peer_id):
+                return False
             self.peerObjects[peer_id] = peer
-            
-            task = asyncio.create_task(peer.connect_to_peer(ip, port))
             self.peer_connections[peer_id] = task
-            
-            def done_callback(t):
-                if peer_id in self.peer_connections:
-                    self.peer_connections[peer_id].cancel()
-                    
-            
-            task.add_done_callback(done_callback)
+            return True
+
+        peer.on_handshake = handshake
+        task = asyncio.create_task(peer.connect_to_peer(ip, port))
+        try:
+            # wait() does not raise when remove_peer cancels the connection
+            await asyncio.wait([task])
+        finally:
+            task.cancel()
+            if peer.peer_id is not None and self.peerObjects.get(peer.peer_id) is peer:
+                del self.peerObjects[peer.peer_id]
+                self.peer_connections.pop(peer.peer_id, None)
+        return peer.has_handshaked, peer.meters.download.total
 
-    async def updateChokeStatus(self, interval=10.0):
+    async def updateChokeStatus(self, interval=RECHOKE_INTERVAL):
+        loop = asyncio.get_running_loop()
+        next_rechoke = 0.0
         while self._running:
             try:
-                active_peers = []
-                for peer in self.peerObjects.values():
-                    if not peer.has_handshaked or peer.writer is None:
-                        continue
-                        
-                    if peer.peer_id == b'-PY0001-000000000000':
-                        continue
-                        
-                    rate = (peer.get_upload_rate() if self.pieceManager.get_metrics()["left"] == 0 else peer.get_download_rate())
-                    
-                    peer_state = self.peer_manager.peers[peer.peer_id]
-                    active_peers.append((peer, rate, peer_state.interested))
-
-                active_peers.sort(key=lambda x: (x[2], x[1]), reverse=True)
-                
-                unchoked_peers = set()
-                
-                regular_slots = [p for p, _, interested in active_peers if interested][:3]
-                unchoked_peers.update(regular_slots)
-                
-                remaining = [p for p, _, interested in active_peers if interested and p not in unchoked_peers]
-                if remaining:
-                    unchoked_peers.add(random.choice(remaining))
-
-                for peer in self.peerObjects.values():
-                    if peer.writer is None:
-                        continue
-                        
-                    try:                        
-                        if (peer in unchoked_peers or peer.peer_id == b'-PY0001-000000000000'):
-                            await peer.send_message(peer.writer, MessageType.UNCHOKE)
-                            self.peer_manager.set_peer_unchoked(peer.peer_id, True)
-                        else:
-                            await peer.send_message(peer.writer, MessageType.CHOKE)
-                            self.peer_manager.set_peer_unchoked(peer.peer_id, False)
-                    except Exception as e:
-                        await self.remove_peer(peer.peer_id)
-                        
+                if loop.time() >= next_rechoke:
+                    seeding = self.pieceManager.get_metrics()["left"] == 0
+                    changes = self.choker.rechoke(self.peer_manager.meters.upload.rate(), seeding)
+                    next_rechoke = loop.time() + interval
+                else:
+                    # a peer became interested; use free slots now rather than at the next round
+                    changes = self.choker.fill_free_slots()
+                await self.send_choke_changes(changes)
             except Exception as e:
                 print(f"Error in choke update: {e}")
-                
-            await asyncio.sleep(interval)
 
-    async def request_loop(self, interval=.5):
+            self.choke_wakeup.clear()
+            try:
+                await asyncio.wait_for(self.choke_wakeup.wait(), max(0.0, next_rechoke - loop.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def send_choke_changes(self, changes: List[Tuple[str, bool]]):
+        for peer_id, choke in changes:
+            peer = self.peerObjects.get(peer_id)
+            if peer is None or peer.writer is None:
+                continue
+            try:
+                if choke:
+                    # a choked peer's outstanding requests are discarded
+                    peer.upload_queue.clear()
+                    await peer.send_message(peer.writer, MessageType.CHOKE)
+                else:
+                    await peer.send_message(peer.writer, MessageType.UNCHOKE)
+            except Exception as e:
+                await self.remove_peer(peer_id)
+
+    async def request_loop(self, interval=2.0):
+        # requests are refilled as blocks and UNCHOKEs arrive; this only catches timeouts and stragglers
         while self._running:
             try:
                 await self.peer_manager.request_blocks()
@@ -123,24 +133,30 @@ class TorrentClient:
                 print(f"Error in request loop: {e}")
             await asyncio.sleep(interval)
 
-    async def run(self, peer_list: List):
+    async def run(self, peer_list: List, listen: bool = True):
+        '''Runs the torrent; a Session passes listen=False and dispatches incoming connections itself.'''
         try:
-            self.server = await asyncio.start_server(
-                self.handle_incoming_connection,
-                host='0.0.0.0',
-                port=self.port
-            )
-            async with self.server:
-                await asyncio.gather(
-                    self.start_downloading(peer_list),
-                    self.updateChokeStatus(),
-                    self.request_loop(),
-                    self.server.serve_forever()
+            loops = [
+                self.start_downloading(peer_list),
+                self.connections.run(),
+                self.updateChokeStatus(),
+                self.request_loop()
+            ]
+            if listen:
+                self.server = await asyncio.get_running_loop().create_server(
+                    lambda: WireProtocol(self.handle_incoming_connection),
+                    host='0.0.0.0',
+                    port=self.port
                 )
+                loops.append(self.server.serve_forever())
+            await asyncio.gather(*loops)
         except Exception as e:
             print(f"Error in torrent client: {e}")
         finally:
             self._running = False
+            self.connections.close()
+            for peer_id in list(self.peer_connections):
+                await self.remove_peer(peer_id)
             if self.server:
                 self.server.close()
                 await self.server.wait_closed()
@@ -148,15 +164,25 @@ class TorrentClient:
     def get_peer_connections(self) -> Dict[str, asyncio.Task]:
         return self.peer_connections
 
-    async def handle_incoming_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    def get_stats(self) -> dict:
+        return self.peer_manager.get_stats()
+
+    def set_rate_limits(self, **limits):
+        '''Changes upload/download/peer_upload/peer_download limits (bytes/s, 0 = unlimited) while running.'''
+        self.peer_manager.limits.set_limits(**limits)
+
+    async def handle_incoming_connection(self, reader: WireProtocol, writer: WireWriter,
+                                         handshake: Optional[Handshake] = None):
+        '''Serves an incoming peer; a Session passes the handshake it already read to find the torrent.'''
         peer_info = writer.get_extra_info('peername')        
         if not peer_info:
             writer.close()
             return
 
+        accepted = False
         try:
-            data = await reader.readexactly(68)
-            handshake = Handshake.decode(data)
+            if handshake is None:
+                handshake = Handshake.decode(await reader.read_handshake())
             
             if handshake.info_hash != self.info_hash:
                 writer.close()
@@ -167,6 +193,12 @@ class TorrentClient:
             if not peer_id or peer_id == self.my_id:
                 writer.close()
                 return
+
+            if not self.connections.accept(peer_id, peer_info[0]):
+                # banned, already connected or out of connection slots
+                writer.close()
+                return
+            accepted = True
                 
             our_handshake = Handshake(self.info_hash, self.my_id)
             writer.write(our_handshake.encode())
@@ -177,7 +209,7 @@ class TorrentClient:
             peer.peer_id = peer_id
             peer.has_handshaked = True
             self.peerObjects[peer_id] = peer
-            self.peer_manager.add_peer(peer_id, writer)
+            self.peer_manager.add_peer(peer_id, writer, peer.meters)
             peer.writer = writer
             
             bitfield = self.pieceManager.get_bitfield()
@@ -191,4 +223,7 @@ class TorrentClient:
         except Exception as e:
             print(f"Error handling incoming connection: {e}")
             if 'peer_id' in locals() and peer_id:
-                await self.remove_peer(peer_id)
\ No newline at end of file
+                await self.remove_peer(peer_id)
+        finally:
+            if accepted:
+                self.connections.release(peer_id)
\ No newline at end of file
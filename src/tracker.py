@@ -1,187 +1,95 @@
-import asyncio
 import socket
-from typing import List, Tuple, Dict, Any
+from typing import List, Optional, Tuple
 import bencodepy
 from enum import IntEnum
-from urllib.parse import urlparse
-import ssl
-import certifi
+from urllib.parse import quote_from_bytes, urlparse, urlunparse
+from http_client import HTTPClient, shared_client
+
+ANNOUNCE_TIMEOUT = 30.0
 
 class Event(IntEnum):
     STARTED = 0
     STOPPED = 1
     COMPLETED = 2
 
+class TrackerError(Exception):
+    '''The tracker answered with an error or a response we cannot use.'''
+
+def parse_compact_peers(data: bytes, ipv6: bool = False) -> List[Tuple[str, int, str]]:
+    '''Decodes compact peers: 4-byte IPv4 (or 16-byte IPv6) address plus 2-byte port each.'''
+    family, size = (socket.AF_INET6, 16) if ipv6 else (socket.AF_INET, 4)
+    stride = size + 2
+    peers = []
+    for i in range(0, len(data) - stride + 1, stride):
+        ip = socket.inet_ntop(family, data[i:i + size])
+        port = (data[i + size] << 8) | data[i + size + 1]
+        peers.append((ip, port, ""))
+    return peers
+
+def scrape_url(announce_url: str) -> str:
+    '''The scrape convention: replace "announce" in the last path segment with "scrape".'''
+    url = urlparse(announce_url)
+    head, _, last = url.path.rpartition("/")
+    if not last.startswith("announce"):
+        raise TrackerError("tracker does not support scrape")
+    return urlunparse(url._replace(path=f"{head}/scrape{last[len('announce'):]}"))
+
 class Tracker:
-    def __init__(self, tracker_port: int, tracker_url, client_port, peer_id: bytes, info_hash):
+    def __init__(self, tracker_port: int, tracker_url, client_port, peer_id: bytes, info_hash,
+                 http_client: Optional[HTTPClient] = None, timeout: float = ANNOUNCE_TIMEOUT):
         self.peer_id: bytes = peer_id
         self.tracker_port: int = tracker_port
         self.client_port = client_port
         self.info_hash = info_hash
         self.tracker_url = tracker_url
+        self.http = http_client or shared_client()
+        self.timeout = timeout
 
-    async def announce(self, uploaded, downloaded, left, compact) -> Tuple[List[Tuple[str, int, str]], int]:
-        # request = "GET /announce?"
-        # params = "&".join([
-        #     f"peer_id={self.peer_id}",
-        #     f"port={self.client_port}",
-        #     f"uploaded={uploaded}",
-        #     f"downloaded={downloaded}",
-        #     f"left={left}",
-        #     f"compact={1 if compact else 0}",
-        #     f"info_hash={''.join(['%' + f'{b:02x}' for b in self.info_hash])}"
-        # ])
-        # request = request+params
-        
-        # headers_str = "\r\n".join([
-        #         f"Host: {self.tracker_url}",
-        #         f"Accept: */*",
-        #         f"Accept-Encoding: deflate, gzip"
-        #     ])
-        
-        # http_request = request + "\r\n" + headers_str + "\r\n\r\n"
-        
-        # reader, writer = await asyncio.open_connection(self.tracker_url, self.tracker_port)
-        
-        # writer.write(http_request.encode())
-        # await writer.drain()
-        url = urlparse(self.tracker_url)
-        scheme = url.scheme 
-        use_ssl = scheme == "https"
-        hostname = url.hostname
-        path = url.path or "/announce"
-        port = url.port or (443 if scheme == "https" else 80)
+    def _query_url(self, base: str, params: List[Tuple[str, str]]) -> str:
+        # the announce URL may carry its own query string (e.g. a passkey)
+        separator = "&" if urlparse(base).query else "?"
+        return base + separator + "&".join(f"{name}={value}" for name, value in params)
 
-        params = "&".join([
-            f"peer_id={self.peer_id}",
-            f"port={self.client_port}",
-            f"uploaded={uploaded}",
-            f"downloaded={downloaded}",
-            f"left={left}",
-            f"compact={1 if compact else 0}",
-            f"info_hash={''.join(['%' + f'{b:02x}' for b in self.info_hash])}"
-        ])
-        request_line = f"GET {path}?{params} HTTP/1.1"
+    async def _get(self, url: str) -> dict:
+        response = await self.http.get(url, self.timeout)
+        if response.status != 200:
+            raise TrackerError(f"tracker returned HTTP {response.status}")
+        try:
+            result = bencodepy.decode(response.body)
+        except Exception as e:
+            raise TrackerError(f"undecodable tracker response: {e}")
+        if not isinstance(result, dict):
+            raise TrackerError("tracker response is not a dictionary")
+        if b"failure reason" in result:
+            raise TrackerError(result[b"failure reason"].decode("utf-8", "replace"))
+        return result
 
-        headers_str = "\r\n".join([
-            f"Host: {hostname}",
-            f"Accept: */*",
-            f"Accept-Encoding: deflate, gzip"
+    async def announce(self, uploaded, downloaded, left, compact) -> Tuple[List[Tuple[str, int, str]], int]:
+        peer_id = self.peer_id if isinstance(self.peer_id, bytes) else self.peer_id.encode()
+        url = self._query_url(self.tracker_url, [
+            ("info_hash", quote_from_bytes(self.info_hash, safe="")),
+            ("peer_id", quote_from_bytes(peer_id, safe="")),
+            ("port", str(self.client_port)),
+            ("uploaded", str(uploaded)),
+            ("downloaded", str(downloaded)),
+            ("left", str(left)),
+            ("compact", "1" if compact else "0"),
         ])
+        bencode_dict = await self._get(url)
 
-        http_request = request_line + "\r\n" + headers_str + "\r\n\r\n"
-
-        if scheme == "https":
-            context = ssl.create_default_context(cafile=certifi.where())
-            reader, writer = await asyncio.open_connection(hostname, port, ssl=context)
+        peers: List[Tuple[str, int, str]] = []
+        peers_data = bencode_dict.get(b"peers", b"")
+        if isinstance(peers_data, list):
+            for peer in peers_data:
+                peers.append((peer[b"ip"].decode("ascii"), int(peer[b"port"]), peer.get(b"peer id", "")))
         else:
-            reader, writer = await asyncio.open_connection(hostname, port)
-            
-        writer.write(http_request.encode())
-        await writer.drain()
-        
-        chunks = []
-        while True:
-            chunk = await reader.read(2048)
-            if not chunk:
-                break
-            chunks.append(chunk)
-        
-        writer.close()
-        await writer.wait_closed()
-        
-        response = b''.join(chunks)
-        try:
-            if b'\r\n\r\n' in response:
-                headers_part, body = response.split(b'\r\n\r\n', 1)
-            else:
-                body = response
-                
-            if b'd8:interval' in body:
-                body = body[body.index(b'd8:interval'):]
-            
-            bencode_dict = bencodepy.decode(body)
-            
-            peers: List[Tuple[str, int, str]] = []
-            if isinstance(bencode_dict[b"peers"], list):
-                for peer in bencode_dict[b"peers"]:               
-                        peers.append(
-                            (
-                            peer[b"ip"].decode("ascii"), 
-                            int(peer[b"port"]),
-                            peer[b"peer id"]
-                            )
-                        )
-            else:
-                peers_data = bencode_dict[b"peers"]
-                for i in range(0, len(peers_data), 6):
-                    ip_bytes = peers_data[i:i+4]
-                    ip = socket.inet_ntoa(ip_bytes)
-                    port = (peers_data[i+4] << 8) | peers_data[i+5]
-                    peers.append((ip, port, ""))
+            peers = parse_compact_peers(peers_data)
+        peers += parse_compact_peers(bencode_dict.get(b"peers6", b""), ipv6=True)
+        return peers, bencode_dict[b"interval"]
 
-            interval = bencode_dict[b"interval"]
-            return (peers, interval)
-        except Exception:
-            if b'peers' in response and b'interval' in response:
-                try:
-                    bencode_dict = bencodepy.decode(response)
-                    peers_data = bencode_dict[b"peers"]
-                    peers = []
-                    for i in range(0, len(peers_data), 6):
-                        ip_bytes = peers_data[i:i+4]
-                        ip = socket.inet_ntoa(ip_bytes)
-                        port = (peers_data[i+4] << 8) | peers_data[i+5]
-                        peers.append((ip, port, ""))
-                    return (peers, bencode_dict[b"interval"])
-                except:
-                    raise
-            raise
-        
     async def scrape(self) -> dict:
-        # Parse the tracker URL
-        url = urlparse(self.tracker_url)
-        hostname = url.hostname
-        scheme = url.scheme
-        port = url.port or (443 if scheme == "https" else 80)
-
-        request = f"GET /scrape?info_hash={''.join(['%' + f'{x:02x}' for x in self.info_hash])}"
-
-        headers_str = "\r\n".join([
-            f"Host: {hostname}",
-            "Accept: */*",
-            "Accept-Encoding: deflate, gzip"
+        url = self._query_url(scrape_url(self.tracker_url), [
+            ("info_hash", quote_from_bytes(self.info_hash, safe="")),
         ])
-        
-        http_request = request + "\r\n" + headers_str + "\r\n\r\n"
-
-        if scheme == "https":
-            context = ssl.create_default_context(cafile=certifi.where())
-            reader, writer = await asyncio.open_connection(hostname, port, ssl=context)
-        else:
-            reader, writer = await asyncio.open_connection(hostname, port)
-
-        writer.write(http_request.encode())
-        await writer.drain()
-        
-        chunks = []
-        while True:
-            chunk = await reader.read(2048)
-            if not chunk:
-                break
-            chunks.append(chunk)
-
-        writer.close()
-        await writer.wait_closed()
-
-        response = b''.join(chunks)
-        try:
-            if b'\r\n\r\n' in response:
-                _headers_part, body = response.split(b'\r\n\r\n', 1)
-            else:
-                body = response
-            bencode_dict = bencodepy.decode(body)
-            return bencode_dict[b"files"]
-        except:
-            bencode_dict = bencodepy.decode(response)
-            return bencode_dict[b"files"]
\ No newline at end of file
+        bencode_dict = await self._get(url)
+        return bencode_dict[b"files"]
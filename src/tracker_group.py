@@ -0,0 +1,113 @@
+import asyncio
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from tracker import Tracker, TrackerError
+from udp_tracker import RETRANSMIT_BASE, UDPTracker
+
+DEFAULT_TRACKER_PORT = 6969
+# how long one tracker may take before the rest of its tier is used without it
+ANNOUNCE_TIMEOUT = 15.0
+# UDP retransmits after 2, 4 and 8 s fit the announce timeout, where BEP 15's 15 s
+# schedule would be cut off before its first retransmission
+UDP_RETRANSMIT_BASE = 2.0
+# after the first tracker in a tier answers, wait this long for the others to merge their peers
+MERGE_GRACE = 1.0
+
+def create_tracker(tracker_url: str, client_port, peer_id, info_hash, tracker_port: Optional[int] = None,
+                   timeout: Optional[float] = None):
+    '''
+    Returns the client for the URL's scheme; both kinds share the announce/scrape
+    interface. With a timeout, UDP retransmissions are scheduled to fit inside it.
+    '''
+    tracker_port = tracker_port or urlparse(tracker_url).port or DEFAULT_TRACKER_PORT
+    kwargs = dict(tracker_port=tracker_port, tracker_url=tracker_url, client_port=client_port,
+                  peer_id=peer_id, info_hash=info_hash)
+    if urlparse(tracker_url).scheme != "udp":
+        return Tracker(**kwargs)
+    if timeout is not None:
+        kwargs.update(retransmit_base=min(RETRANSMIT_BASE, UDP_RETRANSMIT_BASE * timeout / ANNOUNCE_TIMEOUT),
+                      timeout=timeout)
+    return UDPTracker(**kwargs)
+
+class TrackerGroup:
+    '''
+    Multi-tracker announce (BEP 12) behind the single-tracker interface.
+    Tiers are tried in order; all trackers of a tier are announced to at
+    once, each with its own timeout. Peers from every tracker that answers
+    within MERGE_GRACE of the first one are merged and deduplicated, and the
+    first tracker to answer moves to the front of its tier.
+    '''
+    def __init__(self, tiers: List[List[str]], client_port, peer_id, info_hash,
+                 announce_timeout: float = ANNOUNCE_TIMEOUT):
+        self.tiers = [
+            [create_tracker(url, client_port, peer_id, info_hash, timeout=announce_timeout) for url in tier]
+            for tier in tiers if tier
+        ]
+        self.announce_timeout = announce_timeout
+        # tracker url -> seconds its last successful announce took
+        self.response_times: Dict[str, float] = {}
+
+    async def _announce_one(self, tracker, uploaded, downloaded, left, compact):
+        start = time.monotonic()
+        result = await asyncio.wait_for(tracker.announce(uploaded, downloaded, left, compact), self.announce_timeout)
+        self.response_times[tracker.tracker_url] = time.monotonic() - start
+        return tracker, result
+
+    async def _announce_tier(self, tier: list, uploaded, downloaded, left, compact):
+        tasks = [asyncio.create_task(self._announce_one(t, uploaded, downloaded, left, compact)) for t in tier]
+        answered = []
+        pending = set(tasks)
+        deadline = None
+        try:
+            while pending:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        answered.append(task.result())
+                    else:
+                        print(f"Tracker announce failed: {task.exception()!r}")
+                if answered and deadline is None:
+                    deadline = time.monotonic() + MERGE_GRACE
+        finally:
+            for task in pending:
+                task.cancel()
+        return answered
+
+    async def announce(self, uploaded, downloaded, left, compact) -> Tuple[List[Tuple[str, int, str]], int]:
+        for tier in self.tiers:
+            answered = await self._announce_tier(tier, uploaded, downloaded, left, compact)
+            if not answered:
+                continue
+            fastest = answered[0][0]
+            tier.remove(fastest)
+            tier.insert(0, fastest)
+
+            peers: Dict[Tuple[str, int], Tuple[str, int, str]] = {}
+            for _, (tracker_peers, _interval) in answered:
+                for peer in tracker_peers:
+                    known = peers.get((peer[0], peer[1]))
+                    if known is None or (not known[2] and peer[2]):
+                        peers[(peer[0], peer[1])] = peer
+            interval = min(result[1] for _, result in answered)
+            return list(peers.values()), interval
+        raise TrackerError("no tracker answered the announce")
+
+    async def scrape(self) -> dict:
+        for tier in self.tiers:
+            for tracker in tier:
+                try:
+                    return await asyncio.wait_for(tracker.scrape(), self.announce_timeout)
+                except Exception as e:
+                    print(f"Scrape of {tracker.tracker_url} failed: {e!r}")
+        raise TrackerError("no tracker answered the scrape")
+
+    def close(self):
+        for tier in self.tiers:
+            for tracker in tier:
+                if hasattr(tracker, "close"):
+                    tracker.close()
@@ -0,0 +1,158 @@
+import asyncio
+import random
+import struct
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from tracker import TrackerError, parse_compact_peers
+
+# BEP 15 constants
+PROTOCOL_ID = 0x41727101980
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+EVENT_NONE = 0
+
+# a connection id may be reused for one minute after it was issued
+CONNECTION_ID_TTL = 60.0
+# request n is retransmitted after RETRANSMIT_BASE * 2**n seconds, n = 0..MAX_RETRANSMITS
+RETRANSMIT_BASE = 15.0
+MAX_RETRANSMITS = 8
+
+# (host, port) -> (connection id, monotonic time it was issued), shared by every torrent
+_connection_ids: Dict[Tuple[str, int], Tuple[int, float]] = {}
+
+class _TrackerProtocol(asyncio.DatagramProtocol):
+    '''Routes responses to the waiting request by transaction id.'''
+    def __init__(self):
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.waiters: Dict[int, asyncio.Future] = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if len(data) < 8:
+            return
+        transaction_id = struct.unpack_from(">I", data, 4)[0]
+        waiter = self.waiters.pop(transaction_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(data)
+
+    def _fail_all(self, exc: Exception):
+        for waiter in self.waiters.values():
+            if not waiter.done():
+                waiter.set_exception(exc)
+        self.waiters.clear()
+
+    def error_received(self, exc: Exception):
+        # e.g. ICMP port unreachable; no point waiting out the retransmit timer
+        self._fail_all(exc)
+
+    def connection_lost(self, exc):
+        self._fail_all(exc or ConnectionError("tracker socket closed"))
+        self.transport = None
+
+class UDPTracker:
+    '''
+    UDP tracker client (BEP 15) with the same announce/scrape interface as the
+    HTTP Tracker. A connected datagram socket is kept per tracker, connection
+    ids are cached for their one-minute lifetime and shared between torrents,
+    and unanswered requests are retransmitted after 15 * 2^n seconds. A
+    caller with its own deadline passes a smaller retransmit_base and a
+    timeout, so the retransmissions happen within it.
+    '''
+    def __init__(self, tracker_port: int, tracker_url: str, client_port: int, peer_id, info_hash: bytes,
+                 max_retransmits: int = MAX_RETRANSMITS, retransmit_base: float = RETRANSMIT_BASE,
+                 timeout: Optional[float] = None):
+        url = urlparse(tracker_url)
+        self.host = url.hostname
+        self.tracker_port = url.port or tracker_port
+        self.tracker_url = tracker_url
+        self.client_port = client_port
+        self.peer_id = peer_id if isinstance(peer_id, bytes) else peer_id.encode()
+        self.info_hash = info_hash
+        self.max_retransmits = max_retransmits
+        self.retransmit_base = retransmit_base
+        # bound on a whole announce or scrape, retransmissions included
+        self.timeout = timeout
+        self.key = random.getrandbits(32)
+        self.protocol: Optional[_TrackerProtocol] = None
+
+    async def _endpoint(self) -> _TrackerProtocol:
+        if self.protocol is None or self.protocol.transport is None:
+            _, self.protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+                _TrackerProtocol, remote_addr=(self.host, self.tracker_port))
+        return self.protocol
+
+    async def _send(self, packet: bytes, transaction_id: int, timeout: float) -> bytes:
+        protocol = await self._endpoint()
+        waiter = asyncio.get_running_loop().create_future()
+        protocol.waiters[transaction_id] = waiter
+        try:
+            protocol.transport.sendto(packet)
+            data = await asyncio.wait_for(waiter, timeout)
+        finally:
+            protocol.waiters.pop(transaction_id, None)
+        action = struct.unpack_from(">I", data)[0]
+        if action == ACTION_ERROR:
+            raise TrackerError(data[8:].decode("utf-8", "replace"))
+        return data
+
+    async def _connection_id(self, timeout: float) -> int:
+        key = (self.host, self.tracker_port)
+        cached = _connection_ids.get(key)
+        if cached is not None and time.monotonic() - cached[1] < CONNECTION_ID_TTL:
+            return cached[0]
+        transaction_id = random.getrandbits(32)
+        data = await self._send(struct.pack(">QII", PROTOCOL_ID, ACTION_CONNECT, transaction_id), transaction_id, timeout)
+        if len(data) < 16 or struct.unpack_from(">I", data)[0] != ACTION_CONNECT:
+            raise TrackerError("malformed connect response")
+        connection_id = struct.unpack_from(">Q", data, 8)[0]
+        _connection_ids[key] = (connection_id, time.monotonic())
+        return connection_id
+
+    async def _request(self, action: int, body: bytes) -> bytes:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        for n in range(self.max_retransmits + 1):
+            timeout = self.retransmit_base * 2 ** n
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    break
+            try:
+                # an expired id is fetched again before each retransmission
+                connection_id = await self._connection_id(timeout)
+                transaction_id = random.getrandbits(32)
+                packet = struct.pack(">QII", connection_id, action, transaction_id) + body
+                data = await self._send(packet, transaction_id, timeout)
+            except asyncio.TimeoutError:
+                continue
+            if struct.unpack_from(">I", data)[0] != action:
+                raise TrackerError(f"unexpected action in response to {action}")
+            return data
+        raise TrackerError(f"no response from {self.host}:{self.tracker_port}")
+
+    async def announce(self, uploaded, downloaded, left, compact) -> Tuple[List[Tuple[str, int, str]], int]:
+        # UDP announces are always compact; the flag only exists for the HTTP interface
+        body = struct.pack(">20s20sQQQIIIiH", self.info_hash, self.peer_id, downloaded, left, uploaded,
+                           EVENT_NONE, 0, self.key, -1, self.client_port)
+        data = await self._request(ACTION_ANNOUNCE, body)
+        if len(data) < 20:
+            raise TrackerError("malformed announce response")
+        interval = struct.unpack_from(">I", data, 8)[0]
+        ipv6 = self.protocol.transport.get_extra_info("sockname", ("",))[0].count(":") > 0
+        return parse_compact_peers(data[20:], ipv6=ipv6), interval
+
+    async def scrape(self) -> dict:
+        data = await self._request(ACTION_SCRAPE, self.info_hash)
+        if len(data) < 20:
+            raise TrackerError("malformed scrape response")
+        seeders, completed, leechers = struct.unpack_from(">III", data, 8)
+        return {self.info_hash: {b"complete": seeders, b"downloaded": completed, b"incomplete": leechers}}
+
+    def close(self):
+        if self.protocol is not None and self.protocol.transport is not None:
+            self.protocol.transport.close()
@@ -0,0 +1,280 @@
+import asyncio
+import struct
+from collections import deque
+from typing import Callable, Optional, Tuple
+
+from message import MessageType
+
+RECV_BUFFER_SIZE = 256 * 1024
+MAX_QUEUED_FRAMES = 256
+# larger than any block we request or bitfield we accept; a longer length prefix is an attack or garbage
+MAX_FRAME_LENGTH = 2 * 1024 * 1024
+HANDSHAKE = -2
+KEEP_ALIVE = -1
+
+# called with (index, begin, length, protocol) when a PIECE header arrives; returns
+# the destination view for the block or None to receive it as an ordinary payload
+BlockSink = Callable[[int, int, int, "WireProtocol"], Optional[memoryview]]
+
+class WireWriter:
+    '''The part of asyncio.StreamWriter that peers use, on top of a WireProtocol.'''
+    def __init__(self, transport: asyncio.Transport, protocol: "WireProtocol"):
+        self.transport = transport
+        self.protocol = protocol
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writelines(self, data):
+        self.transport.writelines(data)
+
+    async def drain(self):
+        if self.protocol.exception is not None:
+            raise self.protocol.exception
+        if self.transport.is_closing():
+            # let connection_lost run, as StreamWriter.drain does
+            await asyncio.sleep(0)
+        await self.protocol.drain_helper()
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    def close(self):
+        self.transport.close()
+
+    async def wait_closed(self):
+        await self.protocol.closed
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+class WireProtocol(asyncio.BufferedProtocol):
+    '''
+    Frames the peer wire protocol over one reusable receive buffer. Headers are
+    decoded in place with struct.unpack_from and frames are queued for
+    read_frame(). PIECE payloads are received straight into the view returned
+    by block_sink, so block data is copied at most once (for the bytes that
+    arrived together with the header) and usually not at all.
+    '''
+    def __init__(self, on_connection: Optional[Callable] = None, buffer_size: int = RECV_BUFFER_SIZE):
+        self.on_connection = on_connection
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.frames: deque = deque()
+        self.frame_waiter: Optional[asyncio.Future] = None
+        self.block_sink: Optional[BlockSink] = None
+        self.expect_handshake = True
+        # PIECE payload currently being received into a sink view
+        self.piece_dest: Optional[memoryview] = None
+        self.piece_filled = 0
+        self.piece_header: Tuple[int, int, int] = (0, 0, 0)
+        # where the rest of a PIECE goes once divert_piece takes its destination away
+        self.scratch = bytearray()
+        self.transport = None
+        self.writer: Optional[WireWriter] = None
+        self.exception: Optional[Exception] = None
+        self.reading_paused = False
+        self.writing_paused = False
+        self.drain_waiters: deque = deque()
+        self.closed: Optional[asyncio.Future] = None
+        self.connection_task: Optional[asyncio.Task] = None
+
+    def connection_made(self, transport):
+        loop = asyncio.get_running_loop()
+        self.transport = transport
+        self.writer = WireWriter(transport, self)
+        self.closed = loop.create_future()
+        if self.on_connection:
+            self.connection_task = loop.create_task(self.on_connection(self, self.writer))
+
+    def connection_lost(self, exc):
+        # keep a protocol error that caused the close
+        self.exception = self.exception or exc or ConnectionResetError("Connection lost")
+        self._wake_reader()
+        while self.drain_waiters:
+            waiter = self.drain_waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(self.exception)
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        while self.drain_waiters:
+            waiter = self.drain_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def drain_helper(self):
+        if not self.writing_paused:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.drain_waiters.append(waiter)
+        await waiter
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self.piece_dest is not None:
+            return self.piece_dest[self.piece_filled:]
+        if self.end == len(self.buffer):
+            self._make_room(0)
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes: int):
+        if self.piece_dest is not None:
+            self.piece_filled += nbytes
+            if self.piece_filled < len(self.piece_dest):
+                return
+            self.piece_dest = None
+            self._queue(MessageType.PIECE, self.piece_header)
+        else:
+            self.end += nbytes
+        if self.exception is not None:
+            # the connection is being dropped; ignore whatever is still arriving
+            self.start = self.end = 0
+            return
+        self._parse()
+
+    def eof_received(self):
+        return False
+
+    def divert_piece(self, index: int, begin: int):
+        '''
+        Receives the rest of the PIECE in progress, if it is (index, begin),
+        into scratch space instead of the view the block sink returned, once
+        that view has been filled from another source.
+        '''
+        if self.piece_dest is None or self.piece_header[:2] != (index, begin):
+            return
+        length = len(self.piece_dest)
+        if len(self.scratch) < length:
+            self.scratch = bytearray(length)
+        self.piece_dest = memoryview(self.scratch)[:length]
+
+    def feed(self, data: bytes):
+        '''Parses bytes read from the socket before this protocol took it over, e.g. a handed-off handshake.'''
+        view = memoryview(data)
+        while view:
+            buffer = self.get_buffer(len(view))
+            n = min(len(buffer), len(view))
+            buffer[:n] = view[:n]
+            self.buffer_updated(n)
+            view = view[n:]
+
+    def _make_room(self, needed: int):
+        '''Moves unparsed bytes to the front, growing the buffer if one frame does not fit.'''
+        pending = self.end - self.start
+        if max(needed, pending) >= len(self.buffer):
+            new_buffer = bytearray(max(needed, len(self.buffer) * 2))
+            new_buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = new_buffer
+            self.view = memoryview(self.buffer)
+        else:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def _queue(self, message_id: int, payload):
+        self.frames.append((message_id, payload))
+        if len(self.frames) >= MAX_QUEUED_FRAMES and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+        self._wake_reader()
+
+    def _wake_reader(self):
+        waiter = self.frame_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def _parse(self):
+        buffer, view = self.buffer, self.view
+        while self.piece_dest is None:
+            available = self.end - self.start
+            if self.expect_handshake:
+                if available < 1 or available < 49 + buffer[self.start]:
+                    break
+                size = 49 + buffer[self.start]
+                self._queue(HANDSHAKE, bytes(view[self.start:self.start + size]))
+                self.start += size
+                self.expect_handshake = False
+                continue
+            if available < 4:
+                break
+            length = struct.unpack_from(">I", buffer, self.start)[0]
+            if length > MAX_FRAME_LENGTH:
+                self._protocol_error(f"frame of {length} bytes exceeds {MAX_FRAME_LENGTH}")
+                return
+            if length == 0:
+                self.start += 4
+                self._queue(KEEP_ALIVE, None)
+                continue
+
+            if available >= 13 and buffer[self.start + 4] == MessageType.PIECE and self.block_sink and length > 9:
+                index, begin = struct.unpack_from(">II", buffer, self.start + 5)
+                block_length = length - 9
+                dest = self.block_sink(index, begin, block_length, self)
+                if dest is not None:
+                    already = min(available - 13, block_length)
+                    body = self.start + 13
+                    dest[:already] = view[body:body + already]
+                    self.start = body + already
+                    if already == block_length:
+                        self._queue(MessageType.PIECE, (index, begin, block_length))
+                    else:
+                        self.piece_dest = dest
+                        self.piece_filled = already
+                        self.piece_header = (index, begin, block_length)
+                    continue
+
+            if available < 4 + length:
+                if 4 + length > len(buffer) - self.start:
+                    self._make_room(4 + length)
+                break
+            message_id = buffer[self.start + 4]
+            payload = bytes(view[self.start + 5:self.start + 4 + length])
+            self.start += 4 + length
+            self._queue(message_id, payload)
+
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.buffer_size:
+                # a large frame grew the buffer; do not keep that memory for the whole connection
+                self.buffer = bytearray(self.buffer_size)
+                self.view = memoryview(self.buffer)
+
+    def _protocol_error(self, message: str):
+        self.exception = ValueError(message)
+        self.start = self.end = 0
+        self._wake_reader()
+        if self.transport is not None:
+            self.transport.abort()
+
+    async def read_frame(self) -> Tuple[int, object]:
+        '''
+        Returns (message id, payload). Control payloads are bytes. A PIECE that
+        went through block_sink yields an (index, begin, length) tuple because
+        the data is already in place; otherwise its payload is the raw bytes.
+        '''
+        while not self.frames:
+            if self.exception is not None:
+                raise self.exception
+            self.frame_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.frame_waiter
+            finally:
+                self.frame_waiter = None
+        frame = self.frames.popleft()
+        if self.reading_paused and len(self.frames) < MAX_QUEUED_FRAMES // 2:
+            self.reading_paused = False
+            self.transport.resume_reading()
+        return frame
+
+    async def read_handshake(self) -> bytes:
+        message_id, payload = await self.read_frame()
+        if message_id != HANDSHAKE:
+            raise ValueError("Expected handshake")
+        return payload